@@ -0,0 +1,143 @@
+"""
+Benchmarks of the netcdf hot paths on synthetic grids.
+
+Every case builds a synthetic dataset in memory (no network, no files), then
+times each operation and records its peak memory with tracemalloc. The results
+go to a JSON file that can be compared with the one of another version:
+
+    python benchmarks/bench_netcdf.py --grid 2.5 --years 10 --levels 1 -o new.json
+    python benchmarks/bench_netcdf.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+from netcdf_analysis import netcdf
+
+
+grids={"2.5":2.5,"1":1.0,"0.25":0.25}
+
+
+def synthetic(grid=2.5,years=10,levels=1,timescale="daily",seed=0):
+    """Synthetic dataset with an annual cycle and noise, as written by get_data.
+
+    Args:
+        grid (float, optional): Resolution in degrees. Defaults to 2.5.
+        years (int, optional): Number of years. Defaults to 10.
+        levels (int, optional): Number of pressure levels, 1 gives 3-D data. Defaults to 1.
+        timescale (str, optional): "daily" (365 days per year) or "monthly". Defaults to "daily".
+    """
+    lat=np.linspace(90,-90,int(round(180/grid))+1)
+    lon=np.arange(0,360,grid)
+    nt=years*(365 if timescale=="daily" else 12)
+    rng=np.random.default_rng(seed)
+    cycle=np.cos(2*np.pi*np.arange(nt)/(365 if timescale=="daily" else 12)).astype("float32")
+    shape=(nt,levels,len(lat),len(lon)) if levels>1 else (nt,len(lat),len(lon))
+    data=rng.standard_normal(shape,dtype="float32")
+    data+=cycle.reshape((nt,)+(1,)*(len(shape)-1))
+    dims=("time","level","lat","lon") if levels>1 else ("time","lat","lon")
+    coords={"time":np.arange(nt,dtype="float64"),"lat":lat,"lon":lon}
+    if levels>1:
+        coords["level"]=np.linspace(1000,10,levels)
+    return xr.Dataset({"air":(dims,data)},coords=coords)
+
+
+def _measure(func,repeat=3):
+    " Best wall time of repeat calls and the peak memory of the first one"
+    tracemalloc.start()
+    st=time.perf_counter()
+    func()
+    times=[time.perf_counter()-st]
+    _,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for _ in range(repeat-1):
+        st=time.perf_counter()
+        func()
+        times.append(time.perf_counter()-st)
+    return min(times),peak/2**20
+
+
+def cases(ds,timescale,start=1981):
+    " The operations to time, each one on a fresh netcdf object so that nothing is cached"
+    dim=4 if ds["air"].ndim==4 else 3
+
+    def fresh():
+        return netcdf(ds,changetime=True,timescale=timescale,start=start,cache_memory=0)
+
+    nc=fresh()
+    other=nc.ds.copy()
+    other["air"]=other["air"]*0.5+1
+    out={"init_changetime":fresh,
+         "mon_climatology":lambda: fresh()._mon_climatology(),
+         "monthly_anomaly":lambda: fresh()._monthly_anomaly(),
+         "annual_mean":lambda: fresh()._annual_mean(),
+         "zonal_mean":lambda: fresh()._zonal_average("air",level=0,timemean=True).values,
+         "correlate":lambda: fresh()._correlate("air",other,dim=dim)}
+    if timescale=="daily":
+        out["daily_anomaly"]=lambda: fresh()._daily_anomaly("air",dim=dim)
+    return out
+
+
+def run(grid="2.5",years=10,levels=1,timescales=("monthly","daily"),repeat=3,only=None):
+    """Run the benchmarks.
+
+    Returns:
+        dict: metadata and one result per case and operation.
+    """
+    results=[]
+    for timescale in timescales:
+        ds=synthetic(grids[str(grid)],years,levels,timescale)
+        case={"grid":str(grid),"years":years,"levels":levels,"timescale":timescale,
+              "shape":list(ds["air"].shape)}
+        for name,func in cases(ds,timescale).items():
+            if only!=None and name not in only:
+                continue
+            seconds,peak=_measure(func,repeat)
+            results.append(dict(case,name=name,seconds=seconds,peak_mb=peak))
+            print("{:>8} {:>18} {:10.4f} s {:10.1f} MB".format(timescale,name,seconds,peak))
+    meta={"python":platform.python_version(),"numpy":np.__version__,"pandas":pd.__version__,
+          "xarray":xr.__version__,"machine":platform.machine(),"cpus":os.cpu_count(),
+          "date":time.strftime("%Y-%m-%dT%H:%M:%S")}
+    return {"meta":meta,"results":results}
+
+
+def compare(old,new):
+    " Print the time and memory ratios new/old of the cases found in both files"
+    key=lambda r: (r["grid"],r["years"],r["levels"],r["timescale"],r["name"])
+    before={key(r):r for r in old["results"]}
+    for r in new["results"]:
+        if key(r) in before:
+            b=before[key(r)]
+            print("{:>8} {:>18} time x{:6.2f} memory x{:6.2f}".format(
+                r["timescale"],r["name"],r["seconds"]/b["seconds"],r["peak_mb"]/max(b["peak_mb"],1e-9)))
+
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid",default="2.5",choices=sorted(grids))
+    parser.add_argument("--years",type=int,default=10)
+    parser.add_argument("--levels",type=int,default=1)
+    parser.add_argument("--timescale",nargs="+",default=["monthly","daily"])
+    parser.add_argument("--repeat",type=int,default=3)
+    parser.add_argument("--only",nargs="+",default=None,help="names of the operations to run")
+    parser.add_argument("-o","--output",default="bench_output.json")
+    parser.add_argument("--compare",nargs=2,metavar=("OLD","NEW"),help="compare two result files")
+    args=parser.parse_args()
+
+    if args.compare!=None:
+        with open(args.compare[0]) as f0, open(args.compare[1]) as f1:
+            compare(json.load(f0),json.load(f1))
+    else:
+        out=run(args.grid,args.years,args.levels,args.timescale,args.repeat,args.only)
+        with open(args.output,"w") as f:
+            json.dump(out,f,indent=1)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# headless plots
+os.environ.setdefault("MPLBACKEND","Agg")
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"src"))
+
+# src/test_file.py is a scratch script, not a test module
+collect_ignore=["src/test_file.py"]
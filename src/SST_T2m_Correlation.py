@@ -0,0 +1,41 @@
+"""
+In this file, we compute the grid point correlation between SST and 2m air temperature
+"""
+
+import argparse
+
+import xarray as xr
+from netcdf_analysis import netcdf
+
+
+def sst_t2m_correlation(sstfile,t2mfile,sstvar="sst",t2mvar="air",lag=0,siglevel=0.05,outfile=None):
+    """Correlation and regression of T2m on SST at every grid point.
+
+    Args:
+        sstfile (str): netcdf file of the SST.
+        t2mfile (str): netcdf file of the 2m air temperature, on the same grid.
+        sstvar (str, optional): SST variable name. Defaults to "sst".
+        t2mvar (str, optional): T2m variable name. Defaults to "air".
+        lag (int, optional): T2m lags SST by this many time steps. Defaults to 0.
+        siglevel (float, optional): Significance level of the correlation. Defaults to 0.05.
+        outfile (str, optional): If given, the result is saved there. Defaults to None.
+    """
+    sst=netcdf(xr.open_dataset(sstfile))
+    t2m=xr.open_dataset(t2mfile)
+    out=sst._correlate(sstvar,t2m,othervar=t2mvar,lag=lag,siglevel=siglevel)
+    if outfile!=None:
+        out.to_netcdf(outfile)
+    return out
+
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("sstfile")
+    parser.add_argument("t2mfile")
+    parser.add_argument("outfile")
+    parser.add_argument("--sstvar",default="sst")
+    parser.add_argument("--t2mvar",default="air")
+    parser.add_argument("--lag",type=int,default=0)
+    parser.add_argument("--siglevel",type=float,default=0.05)
+    args=parser.parse_args()
+    sst_t2m_correlation(args.sstfile,args.t2mfile,args.sstvar,args.t2mvar,args.lag,args.siglevel,args.outfile)
@@ -0,0 +1,64 @@
+"""
+This file contains an uncompressed, memory-mapped cache of one variable, laid
+out for time series access.
+
+The variable is written once to a .npy file with time as the last axis, so the
+time series of every grid point is contiguous. Opening the file maps it without
+reading it: the kernels work on numpy views of it, and the processes that open
+the same file share one copy of the data through the page cache.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+
+def _coords_file(filename):
+    return filename[:-len(".npy")]+".coords.nc" if filename.endswith(".npy") else filename+".coords.nc"
+
+
+def write_cache(da,filename,block_bytes=64*2**20):
+    """Write a variable to a memory-mappable .npy file, time last.
+
+    The data is read and written in blocks of time steps of about block_bytes,
+    so a dask or file backed variable never has to fit in memory. The files are
+    replaced atomically.
+
+    Args:
+        da (xarray DataArray): The variable, with a time dimension.
+        filename (str): The .npy file. The coordinates go to a ".coords.nc" file next to it.
+        block_bytes (int, optional): Size of the blocks of time steps. Defaults to 64 MB.
+    """
+    dims=[d for d in da.dims if d!="time"]+["time"]
+    shape=tuple(da.sizes[d] for d in dims)
+    if os.path.dirname(filename)!="":
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+
+    tmp=filename+".tmp.npy"
+    out=np.lib.format.open_memmap(tmp,mode="w+",dtype=da.dtype,shape=shape)
+    step=max(1,block_bytes//max(1,int(np.prod(shape[:-1]))*da.dtype.itemsize))
+    for t in range(0,shape[-1],step):
+        out[...,t:t+step]=da.isel(time=slice(t,t+step)).transpose(*dims).values
+    out.flush()
+    del out
+
+    coords=xr.Dataset(coords={d:da[d] for d in dims if d in da.coords},
+                      attrs={"dims":" ".join(dims),"name":da.name if da.name!=None else ""})
+    coords.to_netcdf(_coords_file(filename)+".tmp")
+    os.replace(_coords_file(filename)+".tmp",_coords_file(filename))
+    os.replace(tmp,filename)
+
+
+def open_cache(filename):
+    """Map a file written by write_cache, without reading it.
+
+    Returns:
+        xarray DataArray: read-only, backed by a numpy memmap, with time as the last dimension.
+    """
+    data=np.load(filename,mmap_mode="r")
+    with xr.open_dataset(_coords_file(filename)) as coords:
+        coords=coords.load()
+    dims=coords.attrs["dims"].split()
+    name=coords.attrs["name"] if coords.attrs["name"]!="" else None
+    return xr.DataArray(data,dims=dims,coords={d:coords[d] for d in dims if d in coords.coords},name=name)
@@ -0,0 +1,196 @@
+"""
+This file contains a metadata catalog of a directory of netcdf files, such as
+the yearly files written by get_data.
+
+The catalog records, for every file, its variables (dims, shape, dtype,
+packing, chunk layout and, with h5py, the byte offset of contiguous data), its
+pressure levels, grid, time range and calendar. It is saved as JSON in the
+directory and refreshed incrementally: only the new or modified files are
+opened again. Date, level and region queries then return the files to open
+without scanning the archive.
+"""
+
+import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+try:
+    import h5py
+except ImportError:
+    h5py=None
+
+
+catalog_name=".pyclim_catalog.json"
+_levels=("level","lev","plev")
+
+
+def _isoformat(value):
+    " ISO string of a numpy datetime64 or cftime date, which sort like the dates"
+    if hasattr(value,"isoformat"):
+        return value.isoformat()
+    return str(np.datetime_as_string(np.datetime64(value,"s")))
+
+
+def _offsets(filename,names):
+    " Byte offsets of the contiguous variables, if h5py is installed"
+    if h5py==None:
+        return {}
+    offsets={}
+    try:
+        with h5py.File(filename,"r") as f:
+            for v in names:
+                if v in f and f[v].chunks==None:
+                    offset=f[v].id.get_offset()
+                    offsets[v]=int(offset) if offset!=None else None
+    except OSError:
+        pass
+    return offsets
+
+
+def _describe(filename):
+    " The catalog entry of one file"
+    stat=os.stat(filename)
+    entry={"size":stat.st_size,"mtime":stat.st_mtime}
+    try:
+        ds=xr.open_dataset(filename)
+        decoded=True
+    except ValueError:
+        ds=xr.open_dataset(filename,decode_times=False)
+        decoded=False
+    with ds:
+        offsets=_offsets(filename,list(ds.data_vars))
+        entry["variables"]={}
+        for v,da in ds.data_vars.items():
+            enc=da.encoding
+            entry["variables"][v]={"dims":list(da.dims),"shape":list(da.shape),
+                                   "dtype":str(enc.get("dtype",da.dtype)),
+                                   "chunks":list(enc["chunksizes"]) if enc.get("chunksizes")!=None else None,
+                                   "zlib":bool(enc.get("zlib",False)),
+                                   "scale_factor":float(enc["scale_factor"]) if "scale_factor" in enc else None,
+                                   "add_offset":float(enc["add_offset"]) if "add_offset" in enc else None,
+                                   "offset":offsets.get(v),"units":da.attrs.get("units")}
+        level=[d for d in _levels if d in ds.coords]
+        entry["levels"]=[float(x) for x in ds[level[0]].values] if level else None
+        entry["grid"]={c:{"first":float(ds[c][0]),"last":float(ds[c][-1]),"size":ds.sizes[c]}
+                       for c in ("lat","lon") if c in ds.coords and ds.sizes[c]>0}
+
+        if "time" in ds.coords and decoded and ds.sizes["time"]>0:
+            time=ds["time"].values
+            entry["time"]={"start":_isoformat(time[0]),"end":_isoformat(time[-1]),"size":len(time),
+                           "calendar":ds["time"].dt.calendar if hasattr(ds["time"],"dt") else None}
+        else:
+            # undecodable times: the year in the file name, as netcdf.from_files does
+            found=re.findall(r"(\d{4})",os.path.basename(filename))
+            size=ds.sizes.get("time",0)
+            entry["time"]={"start":"{}-01-01T00:00:00".format(found[-1]),"end":"{}-12-31T23:59:59".format(found[-1]),
+                           "size":size,"calendar":None} if found else None
+    return entry
+
+
+def _bounds(time):
+    " (start, end) ISO strings of a date, a period such as '2001' or '2001-02', or a (start, end) pair"
+    start,end=time if isinstance(time,(tuple,list)) else (time,time)
+    return pd.Period(str(start)).start_time.isoformat(),pd.Period(str(end)).end_time.isoformat()
+
+
+def _overlaps(first,last,bounds):
+    " The coordinate range first..last (either order) intersects bounds"
+    lo,hi=min(first,last),max(first,last)
+    return lo<=max(bounds) and min(bounds)<=hi
+
+
+def _lon_overlaps(grid,lon):
+    " The longitudes of the grid intersect (west, east), in either convention, see netcdf_analysis._select_lon"
+    lo,hi=min(grid["first"],grid["last"]),max(grid["first"],grid["last"])
+    step=(hi-lo)/max(grid["size"]-1,1)
+    if hi-lo+step>=360 or lon[1]-lon[0]>=360:
+        return True
+    base=-180 if lo<0 else 0
+    west,east=(lon[0]-base)%360+base,(lon[1]-base)%360+base
+    if west>east:
+        return hi>=west or lo<=east
+    return lo<=east and west<=hi
+
+
+class Catalog:
+    def __init__(self,path,pattern="*.nc",refresh=True):
+        """The catalog of the files of a directory, loaded from its JSON file.
+
+        Args:
+            path (str): The directory.
+            pattern (str, optional): Glob pattern of the files in it. Defaults to "*.nc".
+            refresh (bool, optional): Bring the catalog up to date now. Defaults to True.
+        """
+        self.path=path
+        self.pattern=pattern
+        self.filename=os.path.join(path,catalog_name)
+        self.files={}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.files=json.load(f)["files"]
+        if refresh==True:
+            self.refresh()
+
+    def refresh(self):
+        """Open only the files added or modified since the last refresh, and forget the removed ones.
+
+        Returns:
+            list: The files described again.
+        """
+        found={os.path.basename(f) for f in glob.glob(os.path.join(self.path,self.pattern))}
+        changed=[]
+        for name in sorted(found):
+            stat=os.stat(os.path.join(self.path,name))
+            entry=self.files.get(name)
+            if entry==None or entry["size"]!=stat.st_size or entry["mtime"]!=stat.st_mtime:
+                self.files[name]=_describe(os.path.join(self.path,name))
+                changed.append(name)
+        removed=set(self.files)-found
+        for name in removed:
+            del self.files[name]
+        if changed or removed or not os.path.exists(self.filename):
+            self.save()
+        return changed
+
+    def save(self):
+        " Write the catalog atomically"
+        with open(self.filename+".tmp","w") as f:
+            json.dump({"version":1,"pattern":self.pattern,"files":self.files},f,indent=1,sort_keys=True)
+        os.replace(self.filename+".tmp",self.filename)
+
+    def query(self,variables=None,time=None,level=None,lat=None,lon=None):
+        """The files holding some variables, dates, pressure levels and region.
+
+        Args:
+            variables (list, optional): All of these variables. Defaults to None (any).
+            time (str or tuple, optional): A date or period, e.g. "2001-02", or (start, end). Defaults to None (any).
+            level (float or tuple, optional): A pressure level, or a (bottom, top) range. Defaults to None (any).
+            lat (tuple, optional): (south, north). Defaults to None (any).
+            lon (tuple, optional): (west, east), across the 0/360 seam when west>east. Defaults to None (any).
+
+        Returns:
+            list: The full paths of the files, sorted by start date.
+        """
+        bounds=_bounds(time) if time!=None else None
+        out=[]
+        for name,entry in self.files.items():
+            if variables!=None and not set(variables)<=set(entry["variables"]):
+                continue
+            if bounds!=None and (entry["time"]==None or entry["time"]["end"]<bounds[0] or entry["time"]["start"]>bounds[1]):
+                continue
+            if level!=None and entry["levels"]!=None:
+                lo,hi=(min(level),max(level)) if isinstance(level,(tuple,list)) else (level,level)
+                if not any(lo<=x<=hi for x in entry["levels"]):
+                    continue
+            grid=entry["grid"]
+            if lat!=None and "lat" in grid and not _overlaps(grid["lat"]["first"],grid["lat"]["last"],lat):
+                continue
+            if lon!=None and "lon" in grid and not _lon_overlaps(grid["lon"],lon):
+                continue
+            out.append((entry["time"]["start"] if entry["time"]!=None else "",name))
+        return [os.path.join(self.path,name) for _,name in sorted(out)]
@@ -0,0 +1,213 @@
+"""
+In this file, we run batches of climatology jobs described by a JSON spec.
+
+    python src/climatology_jobs.py spec.json --workers 4
+
+The spec is a list of jobs, or {"jobs": [...], "workers": 4}. A job is:
+
+    {"files": "data/hgt_{}.nc", "years": [1981, 2020], "base": [1991, 2020],
+     "variables": ["hgt"], "levels": [850, 500],
+     "products": ["mon_climatology", "annual_mean", "DJF", "JJAS"],
+     "output": "out/{product}_{var}_{level}.nc",
+     "changetime": true, "timescale": "monthly"}
+
+The jobs that read the same files are merged, and all their products are
+computed in one pass over the yearly files with the streaming accumulators.
+Independent inputs run in parallel, one process each. Every output is written
+atomically and records the fingerprint of its job and input files, so an
+output that is up to date is skipped.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import xarray as xr
+
+from netcdf_analysis import _encoding, _season_months, _yearly_files
+from streaming_climatology import ClimatologyAccumulator, _open_year
+
+
+# any other product is a season, e.g. "DJF" or "JJAS", computed from the monthly accumulator
+_groups={"mon_climatology":"month","mon_std":"month","daily_climatology":"dayofyear","annual_mean":None}
+_input_keys=("files","years","changetime","timescale","timecord","calendar","leap","base")
+
+
+def _years(years):
+    " [start, end] is an inclusive range, a longer list is taken as is"
+    if years==None:
+        return None
+    if len(years)==2:
+        return list(range(min(years),max(years)+1))
+    return sorted(years)
+
+
+def _product(name,accumulators,annual):
+    " One product of the accumulated data"
+    if name=="mon_climatology":
+        return accumulators["month"].mean()
+    if name=="mon_std":
+        return accumulators["month"].std()
+    if name=="daily_climatology":
+        return accumulators["dayofyear"].mean()
+    if name=="annual_mean":
+        return xr.concat(annual,dim="year")
+    return accumulators["month"].seasonal_mean(_season_months(name))
+
+
+def _level_dim(da):
+    found=[d for d in ("level","lev","plev") if d in da.dims]
+    return found[0] if found else None
+
+
+def plan(spec):
+    """Merge the jobs of a spec into tasks, one per input, and list their outputs.
+
+    Returns:
+        list: One dict per task, with the input, the variables, the products and
+        the outputs, {filename: [(product, var, level), ...]}.
+    """
+    jobs=spec["jobs"] if isinstance(spec,dict) else spec
+    tasks={}
+    for job in jobs:
+        for p in job["products"]:
+            if p not in _groups:
+                _season_months(p)
+        inp={k:job.get(k) for k in _input_keys}
+        inp["years"]=_years(inp["years"])
+        inp["base"]=_years(inp["base"])
+        inp["leap"]=inp["leap"] if inp["leap"]!=None else "feb28"
+        key=json.dumps(inp,sort_keys=True)
+        task=tasks.setdefault(key,dict(inp,variables=[],products=[],outputs={}))
+        levels=job.get("levels") or [None]
+        for var in job["variables"]:
+            if var not in task["variables"]:
+                task["variables"].append(var)
+            for product in job["products"]:
+                if product not in task["products"]:
+                    task["products"].append(product)
+                for level in levels:
+                    filename=job["output"].format(product=product,var=var,level=level if level!=None else "all")
+                    pieces=task["outputs"].setdefault(filename,[])
+                    if (product,var,level) not in pieces:
+                        pieces.append((product,var,level))
+    return list(tasks.values())
+
+
+def _fingerprint(task,filename,files):
+    " Fingerprint of one output: its pieces, the input settings and the files read"
+    sha=hashlib.sha256()
+    inp={k:task[k] for k in _input_keys}
+    sha.update(json.dumps([inp,task["outputs"][filename]],sort_keys=True,default=str).encode())
+    for _,f in files:
+        stat=os.stat(f)
+        sha.update(repr((os.path.abspath(f),stat.st_size,stat.st_mtime)).encode())
+    return sha.hexdigest()
+
+
+def _up_to_date(filename,fingerprint):
+    if not os.path.exists(filename):
+        return False
+    with xr.open_dataset(filename) as ds:
+        return ds.attrs.get("pyclim_fingerprint")==fingerprint
+
+
+def run_task(task,force=False):
+    """Compute the outputs of one task that are not up to date, in one pass over its files.
+
+    Returns:
+        list: The files written.
+    """
+    files=_yearly_files(task["files"],task["years"])
+    if len(files)==0:
+        raise FileNotFoundError("No file matches {}".format(task["files"]))
+    todo={}
+    for filename in task["outputs"]:
+        fp=_fingerprint(task,filename,files)
+        if force or not _up_to_date(filename,fp):
+            todo[filename]=fp
+    if not todo:
+        return []
+
+    products={p for f in todo for p,_,_ in task["outputs"][f]}
+    variables=[v for v in task["variables"] if any(v==var for f in todo for _,var,_ in task["outputs"][f])]
+    accumulators={g:ClimatologyAccumulator(g,task["leap"]) for g in {_groups.get(p,"month") for p in products}-{None}}
+    base=set(task["base"]) if task["base"]!=None else None
+    annual=[]
+    for year,f in files:
+        ds=_open_year(f,year,task["changetime"]==True,task["timescale"] or "monthly",
+                      task["timecord"] or "time",task["calendar"],variables)
+        if "annual_mean" in products:
+            annual.append(ds.groupby("time.year").mean("time"))
+        if base==None or year in base:
+            for acc in accumulators.values():
+                acc.add(ds)
+
+    computed={p:_product(p,accumulators,annual) for p in products}
+    written=[]
+    for filename,fp in todo.items():
+        pieces=task["outputs"][filename]
+        named={}
+        for product,var,level in pieces:
+            da=computed[product][var]
+            if level!=None and _level_dim(da)!=None:
+                da=da.sel({_level_dim(da):[level]})
+            name=var if len({p for p,_,_ in pieces})==1 else "{}_{}".format(var,product)
+            named.setdefault(name,[]).append(da)
+        out=xr.Dataset({name:(das[0] if len(das)==1 else xr.concat(das,dim=_level_dim(das[0])))
+                        for name,das in named.items()})
+        out.attrs={"pyclim_fingerprint":fp,"source":task["files"],
+                   "base_period":"{}-{}".format(min(base),max(base)) if base!=None else "all"}
+        if os.path.dirname(filename)!="":
+            os.makedirs(os.path.dirname(filename),exist_ok=True)
+        out.to_netcdf(filename+".tmp",encoding=_encoding(out))
+        os.replace(filename+".tmp",filename)
+        written.append(filename)
+    return written
+
+
+def run(spec,workers=None,force=False):
+    """Run all the jobs of a spec.
+
+    Args:
+        spec (dict or list): The jobs, see the module docstring.
+        workers (int, optional): Number of processes, one input each. Defaults to spec["workers"] or 1.
+        force (bool, optional): Recompute the outputs that are up to date. Defaults to False.
+
+    Returns:
+        list: The files written.
+    """
+    tasks=plan(spec)
+    if workers==None:
+        workers=spec.get("workers",1) if isinstance(spec,dict) else 1
+    workers=max(1,min(workers,len(tasks)))
+    written=[]
+    if workers==1:
+        for task in tasks:
+            written+=run_task(task,force)
+        return written
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for files in pool.map(run_task,tasks,[force]*len(tasks)):
+            written+=files
+    return written
+
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spec",help="JSON file of the jobs")
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--force",action="store_true",help="recompute the outputs that are up to date")
+    parser.add_argument("--dry-run",action="store_true",help="only print the plan")
+    args=parser.parse_args()
+
+    with open(args.spec) as f:
+        spec=json.load(f)
+    if args.dry_run:
+        for task in plan(spec):
+            print("{} ({} files): {}".format(task["files"],len(_yearly_files(task["files"],task["years"])),
+                                             ", ".join(task["outputs"])))
+    else:
+        for filename in run(spec,args.workers,args.force):
+            print(filename)
@@ -1,38 +1,237 @@
 """
-In this file, we  download the data using request package 
+In this file, we  download the data using request package
 """
 
-import numpy as np
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 
+hgt_data_source="https://downloads.psl.noaa.gov/Datasets/ncep.reanalysis2/Dailies/pressure/hgt.{}.nc"
+manifest_name=".getdata_manifest.json"
+
+def _session(workers=4,retries=3):
+    """Build one pooled session that is shared by all the download threads.
+
+    Args:
+        workers (int, optional): Number of connections kept in the pool. Defaults to 4.
+        retries (int, optional): Retries for failed connections. Defaults to 3.
+    """
+    session=requests.Session()
+    adapter=HTTPAdapter(pool_connections=workers,pool_maxsize=workers,max_retries=retries)
+    session.mount("http://",adapter)
+    session.mount("https://",adapter)
+    return session
+
+def _outfile(yr,path=None,Outfilename=None):
+    " Name of the file for a given year, e.g. path+Outfilename+yr+'.nc'"
+    if Outfilename==None:
+        outfile=str(yr)+"xx"
+    else:
+        outfile=Outfilename+str(yr)
+    if path!=None:
+        return path+outfile+".nc"
+    return outfile+".nc"
+
+def _download(session,link,outfile,chunk_size=1<<20,timeout=60,headers=None):
+    """Stream one file to disk.
+
+    The chunks are written to ``outfile+'.part'``, which is renamed to ``outfile``
+    only when the download is complete. The ETag and Last-Modified of the
+    partial file are kept in ``outfile+'.part.json'``. If both are there, the
+    download resumes from the end of the partial file with a HTTP Range request,
+    and an If-Range header so that a file changed on the server since then is
+    sent again in full.
+
+    Args:
+        session (requests.Session): The pooled session.
+        link (str): Url of the file.
+        outfile (str): Destination of the file.
+        chunk_size (int, optional): Size of the chunks in bytes. Defaults to 1 MiB.
+        timeout (int, optional): Timeout of the connection in seconds. Defaults to 60.
+        headers (dict, optional): Extra headers, e.g. the conditional ones. Defaults to None.
+
+    Returns:
+        dict: The manifest entry of the file, or None if the server answered
+        304 Not Modified.
+    """
+    part=outfile+".part"
+    validator=_load_validator(part)
+    done=os.path.getsize(part) if os.path.exists(part) and validator!=None else 0
+    request=dict(headers or {})
+    if done>0:
+        request["Range"]="bytes={}-".format(done)
+        request["If-Range"]=validator
+
+    with session.get(link,headers=request,stream=True,timeout=timeout,allow_redirects=True) as r:
+        if r.status_code==304:
+            return None
+        if r.status_code==416:
+            # The partial file does not match the remote one anymore, start again
+            _remove_part(part)
+            return _download(session,link,outfile,chunk_size=chunk_size,timeout=timeout,headers=headers)
+        r.raise_for_status()
+        if r.status_code!=206:
+            done=0
+            _save_validator(part,r.headers.get("ETag"),r.headers.get("Last-Modified"))
+        expected=r.headers.get("Content-Length")
+        sha=_checksum(part,chunk_size) if done>0 else hashlib.sha256()
+        with open(part,"ab" if done>0 else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                sha.update(chunk)
+
+    if expected!=None and os.path.getsize(part)!=done+int(expected):
+        raise IOError("Incomplete download of {}, rerun to resume".format(link))
+    os.replace(part,outfile)
+    if os.path.exists(part+".json"):
+        os.remove(part+".json")
+    return _entry(outfile,link,r.headers.get("ETag"),r.headers.get("Last-Modified"),sha.hexdigest())
+
+def _load_validator(part):
+    " The If-Range value of a partial file: its strong ETag, else its Last-Modified, None if unknown"
+    if not os.path.exists(part) or not os.path.exists(part+".json"):
+        return None
+    with open(part+".json") as f:
+        saved=json.load(f)
+    if saved.get("etag")!=None and not saved["etag"].startswith("W/"):
+        return saved["etag"]
+    return saved.get("last_modified")
 
-#hgt_data_source=
+def _save_validator(part,etag,last_modified):
+    " Record the ETag and Last-Modified of the file a partial download belongs to"
+    with open(part+".json","w") as f:
+        json.dump({"etag":etag,"last_modified":last_modified},f)
 
-def _getdata(ystart,yend,path=None,Outfilename=None):
+def _remove_part(part):
+    for f in (part,part+".json"):
+        if os.path.exists(f):
+            os.remove(f)
+
+def _checksum(filename,chunk_size=1<<20):
+    " sha256 of a file, read in chunks"
+    sha=hashlib.sha256()
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size),b""):
+            sha.update(chunk)
+    return sha
+
+def _entry(outfile,link,etag,last_modified,sha256):
+    " The manifest entry of a downloaded file"
+    stat=os.stat(outfile)
+    return {"url":link,"size":stat.st_size,"mtime":stat.st_mtime,
+            "etag":etag,"last_modified":last_modified,"sha256":sha256}
+
+def _load_manifest(filename):
+    " Read the manifest, an empty one if it is not there yet"
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def _save_manifest(manifest,filename):
+    " Write the manifest atomically"
+    with open(filename+".tmp","w") as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    os.replace(filename+".tmp",filename)
+
+def _is_current(entry,outfile,verify=False):
+    """Check that the file on disk is still the one recorded in the manifest.
+
+    Size and modification time are compared, which costs one ``stat``. With
+    ``verify=True`` the checksum is computed again as well.
+    """
+    if entry==None or not os.path.exists(outfile):
+        return False
+    stat=os.stat(outfile)
+    if stat.st_size!=entry["size"] or stat.st_mtime!=entry["mtime"]:
+        return False
+    if verify:
+        return _checksum(outfile).hexdigest()==entry["sha256"]
+    return True
+
+def _fetch(session,link,outfile,entry=None,offline=False,verify=False,chunk_size=1<<20):
+    """Download one year unless the local copy is current.
+
+    Returns:
+        tuple: The manifest entry and whether the file was downloaded.
+    """
+    current=_is_current(entry,outfile,verify)
+    if offline:
+        if not current:
+            raise IOError("{} is missing or changed and offline=True".format(outfile))
+        return entry,False
+
+    headers={}
+    if current:
+        if entry["etag"]!=None:
+            headers["If-None-Match"]=entry["etag"]
+        if entry["last_modified"]!=None:
+            headers["If-Modified-Since"]=entry["last_modified"]
+    new=_download(session,link,outfile,chunk_size=chunk_size,headers=headers)
+    if new==None:
+        return entry,False
+    return new,True
+
+def _getdata(ystart,yend,path=None,Outfilename=None,url=hgt_data_source,
+             workers=4,chunk_size=1<<20,session=None,offline=False,verify=False):
     """We can retrive the climate data
     using request module.
+
+    A manifest (size, ETag/Last-Modified and sha256 of each file) is kept next
+    to the data. On a re-run, the years already on disk are only checked with
+    a conditional request, and with ``offline=True`` no request is sent at all.
+
     Args:
         ystart (int): starting year
         yend (int): ending year
         path (string): The path, where the data will be downloaded
         Outfilename (string): Name of the output file
+        url (string, optional): Link of the yearly files, ``{}`` is replaced by the year. Defaults to the NCEP hgt files.
+        workers (int, optional): Number of years downloaded at the same time. Defaults to 4.
+        chunk_size (int, optional): Size of the chunks written to disk in bytes. Defaults to 1 MiB.
+        session (requests.Session, optional): Session to reuse. Defaults to a new pooled session.
+        offline (bool, optional): Only check the files on disk against the manifest. Defaults to False.
+        verify (bool, optional): Recompute the checksum of the files on disk. Defaults to False.
+
+    Returns:
+        list: The downloaded files, sorted by year. If some years fail, the others
+        are still downloaded and recorded, and the first error is raised.
     """
+    if session==None and not offline:
+        session=_session(workers)
 
-    for yr in tqdm(range(ystart,yend+1)):
-        link="https://downloads.psl.noaa.gov/Datasets/ncep.reanalysis2/Dailies/pressure/hgt.{}.nc".format(yr)
-        r=requests.get(link,allow_redirects=True)
-        if Outfilename==None:
-            outfile=str(yr)+"xx"
-        if Outfilename!=None:
-            outfile=Outfilename+str(yr)
-        if path!=None:
-            open(path+outfile+".nc",'wb').write(r.content)
-        else:
-            open(outfile+".nc",'wb').write(r.content)
+    manifest_file=(path if path!=None else "")+manifest_name
+    manifest=_load_manifest(manifest_file)
 
+    years=range(ystart,yend+1)
+    files={yr:_outfile(yr,path,Outfilename) for yr in years}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs={pool.submit(_fetch,session,url.format(yr),files[yr],
+                          manifest.get(os.path.basename(files[yr])),
+                          offline,verify,chunk_size):yr
+              for yr in years}
+        errors=[]
+        for job in tqdm(as_completed(jobs),total=len(jobs)):
+            try:
+                entry,downloaded=job.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if downloaded:
+                manifest[os.path.basename(files[jobs[job]])]=entry
+                _save_manifest(manifest,manifest_file)
 
+    # the years that succeeded are in the manifest, so a rerun only fetches the failed ones
+    if errors:
+        raise errors[0]
+    return [files[yr] for yr in years]
 
-_getdata(1990,1999,path="/Volumes/Abhirup_HD/CEN/Data/NOAA/Daily/Hgt/metadata/",Outfilename="hgt_")
 
+if __name__=="__main__":
+    _getdata(1990,1999,path="/Volumes/Abhirup_HD/CEN/Data/NOAA/Daily/Hgt/metadata/",Outfilename="hgt_")
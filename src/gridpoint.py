@@ -0,0 +1,85 @@
+"""
+This file contains a process pool runner applying a function to every grid
+point time series of a variable, for the analyses that do not vectorize.
+
+The lat/lon domain is split in tiles, one job per tile. The data goes to the
+workers through the memory-mapped array cache (see array_cache) and the results
+come back through a memory-mapped output file, so no array is pickled.
+"""
+
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+
+def _run_tile(job):
+    " Apply the function to one lat/lon tile, in a worker process"
+    source,target,func,block,lat,lon=job
+    data=np.load(source,mmap_mode="r")[...,lat,lon,:]
+    out=np.load(target,mmap_mode="r+")
+    view=out[...,lat,lon,:]
+    if block==True:
+        result=np.asarray(func(data.reshape(-1,data.shape[-1])),dtype=out.dtype)
+        view[...]=result.reshape(data.shape[:-1]+(-1,))
+    else:
+        for idx in np.ndindex(data.shape[:-1]):
+            view[idx]=func(data[idx])
+    out.flush()
+    return lat,lon
+
+
+def apply_gridpoint(da,func,workers=None,tile=None,block=False,dim="output"):
+    """Apply func to every grid point time series of a mapped variable.
+
+    Args:
+        da (xarray DataArray): A variable from netcdf._array_cache, dims (..., lat, lon, time).
+        func (callable): A module level function (it is sent to the workers by name). It gets
+            the time series of one point and returns a number or a 1-D array of fixed length,
+            or with block=True a 2-D array (points, time) and returns one row per point.
+        workers (int, optional): Number of processes, 1 runs in this process. Defaults to the number of cores.
+        tile (tuple, optional): (lat, lon) size of the tiles. Defaults to latitude bands spanning
+            all the longitudes, about four per worker.
+        block (bool, optional): Call func on blocks of points. Defaults to False.
+        dim (str, optional): Name of the output dimension when func returns arrays. Defaults to "output".
+
+    Returns:
+        xarray DataArray: the results on the grid of da, with a dim dimension for array outputs.
+    """
+    source=da.encoding["source"]
+    if da.dims[-3:]!=("lat","lon","time"):
+        raise ValueError("The variable should have (..., lat, lon, time) dims, not {}".format(da.dims))
+    data=da.values
+    workers=workers if workers!=None else os.cpu_count()
+
+    first=data[(0,)*(data.ndim-1)]
+    probe=np.asarray(func(first[None,:]) if block==True else func(first))
+    scalar=probe.ndim==(1 if block==True else 0)
+    size=1 if scalar else probe.shape[-1]
+
+    nlat,nlon=data.shape[-3],data.shape[-2]
+    if tile==None:
+        tile=(max(1,math.ceil(nlat/(4*workers))),nlon)
+    fd,target=tempfile.mkstemp(suffix=".npy",dir=os.path.dirname(source))
+    os.close(fd)
+    out=np.lib.format.open_memmap(target,mode="w+",dtype="float64",shape=data.shape[:-1]+(size,))
+    del out
+
+    try:
+        jobs=[(source,target,func,block,slice(a,a+tile[0]),slice(b,b+tile[1]))
+              for a in range(0,nlat,tile[0]) for b in range(0,nlon,tile[1])]
+        if workers==1:
+            list(map(_run_tile,jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_run_tile,jobs))
+        result=np.load(target)
+    finally:
+        os.remove(target)
+
+    coords={d:da[d] for d in da.dims[:-1] if d in da.coords}
+    result=xr.DataArray(result,dims=da.dims[:-1]+(dim,),coords=coords)
+    return result.isel({dim:0},drop=True) if scalar else result
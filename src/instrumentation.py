@@ -0,0 +1,136 @@
+"""
+This file contains the opt-in timing and profiling layer of the netcdf class.
+
+Every instrumented method call records its wall time, the bytes read by the
+process, its peak Python/numpy memory (with tracemalloc) and the shape of its
+result, tagged with a phase: load, compute, render or save. When profiling is
+off, the only cost is one attribute check per call.
+"""
+
+import contextlib
+import functools
+import time
+import tracemalloc
+
+import pandas as pd
+
+
+def _bytes_read():
+    " Bytes read by this process so far (Linux), None elsewhere"
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _shape(value):
+    " Shape of a result: a tuple for arrays, the sizes for datasets"
+    sizes=getattr(value,"sizes",None)
+    if sizes!=None and not hasattr(value,"shape"):
+        return dict(sizes)
+    shape=getattr(value,"shape",None)
+    return tuple(shape) if shape!=None else None
+
+
+class Profiler:
+    def __init__(self,callback=None,memory=True):
+        """Collects one event per instrumented call.
+
+        Args:
+            callback (callable, optional): Called with every event (a dict) as soon as it is recorded. Defaults to None.
+            memory (bool, optional): Record the peak memory with tracemalloc, which slows
+                down allocations. Defaults to True.
+        """
+        self.callback=callback
+        self.memory=memory
+        self.events=[]
+        self._stack=[]
+        self._started=False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started=True
+
+    @contextlib.contextmanager
+    def phase(self,method,phase):
+        """Record one call; the yielded event can be completed, e.g. with its shape.
+
+        Args:
+            method (str): Name of the method.
+            phase (str): "load", "compute", "render" or "save".
+        """
+        frame={"peak":0,"base":0}
+        if self.memory:
+            current,peak=tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]["peak"]=max(self._stack[-1]["peak"],peak)
+            tracemalloc.reset_peak()
+            frame["base"]=current
+        event={"method":method,"phase":phase,"depth":len(self._stack),"shape":None}
+        self._stack.append(frame)
+        read=_bytes_read()
+        st=time.perf_counter()
+        try:
+            yield event
+        finally:
+            event["seconds"]=time.perf_counter()-st
+            end=_bytes_read()
+            event["bytes_read"]=end-read if read!=None and end!=None else None
+            self._stack.pop()
+            if self.memory:
+                peak=max(tracemalloc.get_traced_memory()[1],frame["peak"])
+                event["peak_mb"]=(peak-frame["base"])/2**20
+                if self._stack:
+                    self._stack[-1]["peak"]=max(self._stack[-1]["peak"],peak)
+            self.events.append(event)
+            if self.callback!=None:
+                self.callback(event)
+
+    def report(self):
+        " All the events as a DataFrame, in the order they finished"
+        return pd.DataFrame(self.events)
+
+    def summary(self):
+        " Calls, total time, bytes read and largest peak memory per phase and method"
+        df=self.report()
+        if df.empty:
+            return df
+        agg={"calls":("seconds","size"),"seconds":("seconds","sum"),"bytes_read":("bytes_read","sum")}
+        if "peak_mb" in df:
+            agg["peak_mb"]=("peak_mb","max")
+        return df.groupby(["phase","method"]).agg(**agg).sort_values("seconds",ascending=False)
+
+    def stop(self):
+        " Stop tracemalloc if this profiler started it"
+        if self._started:
+            tracemalloc.stop()
+            self._started=False
+
+
+def recording(profiler,method,phase):
+    " Context recording a phase on profiler, or doing nothing if it is None"
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.phase(method,phase)
+
+
+def profiled(phase):
+    """Instrument a netcdf method with the given phase.
+
+    Args:
+        phase (str): "load", "compute", "render" or "save".
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self,*args,**kwargs):
+            if self.profiler is None:
+                return method(self,*args,**kwargs)
+            with self.profiler.phase(method.__name__,phase) as event:
+                out=method(self,*args,**kwargs)
+                event["shape"]=_shape(out)
+            return out
+        return wrapper
+    return decorate
@@ -0,0 +1,171 @@
+"""
+This file contains a headless renderer to draw many maps of the same grid.
+
+The figure, the projection, the colorbar and the Cartopy features (coastlines,
+borders, states, land) are built once, and only the contour layer is replaced
+for every frame.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib import cm, colors
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
+
+
+def _levels(frames,clim=None,clevel=20):
+    " Contour levels shared by all the frames"
+    if clim==None:
+        clim=np.nanpercentile(np.asarray(frames,dtype=float),[2,98])
+    return np.linspace(clim[0],clim[1],clevel)
+
+
+class MapRenderer:
+    def __init__(self,lon,lat,levels,central_longitude=180,figsize=(7.5,4.5),size=12,
+                 extent=None,cmap="jet",cextend="both",cbar_label=None,
+                 cbar_position="horizontal",land=True,features=True,dpi=150):
+        """Build the map template once.
+
+        Args:
+            lon (array): longitudes of the data.
+            lat (array): latitudes of the data.
+            levels (array): contour levels, the same for every frame so that the colorbar stays valid.
+            central_longitude (int, optional): Center of the projection. Defaults to 180.
+            figsize (tuple, optional): Size of the figure. Defaults to (7.5,4.5).
+            size (int, optional): Font size. Defaults to 12.
+            extent (list, optional): [lon0,lon1,lat0,lat1] of the map. Defaults to the data extent.
+            cmap (str, optional): colormap. Defaults to "jet".
+            cextend (str, optional): extend of the colorbar. Defaults to "both".
+            cbar_label (str, optional): label of the colorbar. Defaults to None.
+            cbar_position (str, optional): "horizontal" or "vertical". Defaults to "horizontal".
+            land (bool, optional): Draw the land on top. Defaults to True.
+            features (bool, optional): Draw the coastlines, borders and states. Defaults to True.
+            dpi (int, optional): Resolution of the saved frames. Defaults to 150.
+        """
+        self.lon=np.asarray(lon)
+        self.lat=np.asarray(lat)
+        self.levels=levels
+        self.cmap=cmap
+        self.cextend=cextend
+        self.dpi=dpi
+        self.contour=None
+
+        self.fig=Figure(figsize=figsize,constrained_layout=True)
+        FigureCanvasAgg(self.fig)
+        self.ax=self.fig.add_subplot(projection=ccrs.PlateCarree(central_longitude))
+        if extent==None:
+            extent=[self.lon.min(),self.lon.max(),self.lat.min(),self.lat.max()]
+        self.ax.set_extent(extent,crs=ccrs.PlateCarree())
+
+        if features==True:
+            self.ax.coastlines(resolution='110m')
+            self.ax.add_feature(cfeature.BORDERS.with_scale('50m'))
+            self.ax.add_feature(cfeature.STATES)
+        if land==True:
+            self.ax.add_feature(cfeature.LAND,zorder=2)
+        gl=self.ax.gridlines(crs=ccrs.PlateCarree(),draw_labels=True,
+                             linewidth=1,color='gray',alpha=0.5,linestyle='--')
+        gl.top_labels=False
+        gl.right_labels=False
+        gl.xformatter=LongitudeFormatter()
+        gl.yformatter=LatitudeFormatter()
+        self.title=self.ax.set_title("",fontsize=size)
+
+        # the colorbar only depends on the levels, so it is drawn once
+        mappable=cm.ScalarMappable(norm=colors.BoundaryNorm(levels,256,extend=cextend),cmap=cmap)
+        cb=self.fig.colorbar(mappable,ax=self.ax,orientation=cbar_position,shrink=0.9,
+                             pad=0.03,aspect=40,ticks=levels[::2],format="%3.1f")
+        cb.ax.tick_params(labelsize=size-2)
+        if cbar_label!=None:
+            cb.set_label(label=cbar_label,size=size-2)
+
+    def render(self,data,title=None,outfile=None):
+        """Draw one frame, replacing the previous contour layer.
+
+        Args:
+            data (2-D array): the field on (lat, lon).
+            title (str, optional): title of the frame. Defaults to None.
+            outfile (str, optional): If given, the frame is saved there. Defaults to None.
+        """
+        if self.contour!=None:
+            self.contour.remove()
+        self.contour=self.ax.contourf(self.lon,self.lat,np.asarray(data),levels=self.levels,
+                                      transform=ccrs.PlateCarree(),cmap=self.cmap,extend=self.cextend)
+        self.title.set_text(title if title!=None else "")
+        if outfile!=None:
+            self.fig.savefig(outfile,dpi=self.dpi)
+        return self.fig
+
+    def animate(self,frames,outfile,titles=None,fps=4):
+        """Write all the frames to one animation, e.g. a .gif.
+
+        Args:
+            frames (3-D array): the fields, frame first.
+            outfile (str): destination of the animation.
+            titles (list, optional): one title per frame. Defaults to None.
+            fps (int, optional): frames per second. Defaults to 4.
+        """
+        from matplotlib.animation import FuncAnimation, PillowWriter, FFMpegWriter
+
+        titles=titles if titles!=None else [None]*len(frames)
+        anim=FuncAnimation(self.fig,lambda i: self.render(frames[i],titles[i]),frames=len(frames))
+        writer=PillowWriter(fps=fps) if outfile.endswith(".gif") else FFMpegWriter(fps=fps)
+        anim.save(outfile,writer=writer,dpi=self.dpi)
+
+
+def _render_chunk(job):
+    " Render some frames with one template, in a worker process"
+    lon,lat,levels,template,frames,titles,outfiles=job
+    renderer=MapRenderer(lon,lat,levels,**template)
+    for data,title,outfile in zip(frames,titles,outfiles):
+        renderer.render(data,title,outfile)
+    return outfiles
+
+
+def render_batch(lon,lat,frames,outfiles,titles=None,levels=None,clim=None,clevel=20,workers=1,**template):
+    """Render many frames of the same grid to image files.
+
+    The frames are split in contiguous groups, one per worker process, and
+    every worker builds the map template once.
+
+    Args:
+        lon (array): longitudes of the data.
+        lat (array): latitudes of the data.
+        frames (3-D array): the fields, frame first.
+        outfiles (list): one file per frame.
+        titles (list, optional): one title per frame. Defaults to None.
+        levels (array, optional): contour levels. Defaults to clevel levels between clim.
+        clim (list, optional): colorbar limits [low,high]. Defaults to the 2nd and 98th percentiles of all frames.
+        clevel (int, optional): number of levels. Defaults to 20.
+        workers (int, optional): number of processes. Defaults to 1.
+        **template: passed to MapRenderer.
+
+    Returns:
+        list: the files written.
+    """
+    frames=np.asarray(frames)
+    if levels is None:
+        levels=_levels(frames,clim,clevel)
+    titles=list(titles) if titles!=None else [None]*len(frames)
+    lon,lat=np.asarray(lon),np.asarray(lat)
+    for f in outfiles:
+        if os.path.dirname(f)!="":
+            os.makedirs(os.path.dirname(f),exist_ok=True)
+
+    workers=max(1,min(workers,len(frames)))
+    bounds=np.linspace(0,len(frames),workers+1).astype(int)
+    jobs=[(lon,lat,levels,template,frames[a:b],titles[a:b],outfiles[a:b])
+          for a,b in zip(bounds[:-1],bounds[1:])]
+    if workers==1:
+        return _render_chunk(jobs[0])
+    written=[]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for files in pool.map(_render_chunk,jobs):
+            written+=files
+    return written
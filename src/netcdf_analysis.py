@@ -3,473 +3,1118 @@ This file contains several functions to perform different kinds of analysis
 on netcdf data.
 """
 
+import contextlib
+import copy
+import glob
+import itertools
+import os
+import re
+import tempfile
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import xarray as xr
-import matplotlib.patches as patches
 
+from instrumentation import Profiler, profiled, recording
+from product_cache import ProductCache, ProductStore, cached, fingerprint
+
+
+def _plotting():
+    """The plotting layer, imported on first use.
+
+    matplotlib and cartopy take seconds to import, so analysis-only jobs
+    never load them.
+    """
+    import netcdf_plotting
+    return netcdf_plotting
+
+def _pearson(x,y):
+    """Correlation and least-squares fit of y on x for every column at once.
+
+    Only the time steps where both x and y are finite are used, separately
+    for each grid point.
+
+    Args:
+        x (numpy array): Predictor, time is the first axis.
+        y (numpy array): Predictand, same shape as x.
+
+    Returns:
+        tuple: corr, slope, intercept, pvalue and number of valid pairs,
+        each with the shape of x without the time axis.
+    """
+    from scipy import special
+
+    valid=np.isfinite(x)&np.isfinite(y)
+    n=valid.sum(axis=0)
+    x=np.where(valid,x,0.0)
+    y=np.where(valid,y,0.0)
+    with np.errstate(invalid="ignore",divide="ignore",over="ignore"):
+        mx=x.sum(axis=0)/n
+        my=y.sum(axis=0)/n
+        dx=np.where(valid,x-mx,0.0)
+        dy=np.where(valid,y-my,0.0)
+        sxx=(dx*dx).sum(axis=0)
+        syy=(dy*dy).sum(axis=0)
+        sxy=(dx*dy).sum(axis=0)
+
+        corr=np.clip(sxy/np.sqrt(sxx*syy),-1,1)
+        slope=sxy/sxx
+        intercept=my-slope*mx
+
+        # two sided p-value of the t statistic with n-2 degrees of freedom
+        df=(n-2).astype(float)
+        df[df<1]=np.nan
+        t2=corr**2*df/np.maximum(1-corr**2,np.finfo(float).tiny)
+        pvalue=special.betainc(df/2,0.5,df/(df+t2))
+    return corr,slope,intercept,pvalue,n
+
+
+_cumdays=np.array([0,31,60,91,121,152,182,213,244,274,305,335])
+
+def _dayofyear(time,leap="feb28"):
+    """Calendar day of every time step, the same for a given month and day in all years.
+
+    The days are numbered as in a leap year (Mar 1 is always 61), or 1-360 for
+    the 360_day calendar. With leap="feb28", Feb 29 gets the number of Feb 28.
+    """
+    month=time.dt.month.values
+    day=time.dt.day.values
+    if time.dt.calendar=="360_day":
+        key=(month-1)*30+day
+    else:
+        key=_cumdays[month-1]+day
+        if leap=="feb28":
+            key[key==60]=59
+        elif leap!="separate":
+            raise ValueError("leap should be 'feb28' or 'separate', not {}".format(leap))
+    return xr.DataArray(key,dims="time",coords={"time":time},name="dayofyear")
+
+def _harmonic_smooth(clim,nharm,period):
+    " Least-squares fit of the mean and the first nharm harmonics along dayofyear"
+    t=2*np.pi*clim.dayofyear.values/period
+    basis=[np.ones_like(t)]
+    for k in range(1,nharm+1):
+        basis+=[np.cos(k*t),np.sin(k*t)]
+    basis=np.stack(basis,axis=1).astype(clim.dtype if clim.dtype.kind=="f" else "float64")
+    A=xr.DataArray(basis,dims=("dayofyear","harmonic"),coords={"dayofyear":clim.dayofyear})
+    P=xr.DataArray(np.linalg.pinv(basis),dims=("harmonic","dayofyear"),coords={"dayofyear":clim.dayofyear})
+    coef=xr.dot(P,clim,dim="dayofyear")
+    return xr.dot(A,coef,dim="harmonic").transpose(*clim.dims).rename(clim.name)
+
+
+_timescales={"monthly":"MS","daily":"D"}
+_day=np.int64(86400*10**9)
+
+def _make_time(timelen,start,timescale="monthly",calendar=None):
+    """Rebuild a time axis of timelen steps, without looking at the data.
+
+    Args:
+        timelen (int): Number of time steps.
+        start (int or str): A year (the axis starts on Jan 1) or a date, e.g. "1981-06-01".
+        timescale (str, optional): "monthly", "daily" or any pandas frequency, e.g. "6h". Defaults to "monthly".
+        calendar (str, optional): "standard", "noleap" (365 days, Feb 29 is skipped) or "360_day".
+            Defaults to "noleap" for daily data and "standard" otherwise.
+
+    Returns:
+        The time axis, numpy datetime64 values except for the 360_day calendar
+        which needs cftime dates.
+    """
+    freq=_timescales.get(timescale,timescale)
+    if calendar==None:
+        calendar="noleap" if timescale=="daily" else "standard"
+    if isinstance(start,(int,np.integer)):
+        start="{:04d}-01-01".format(start)
+
+    if calendar=="360_day":
+        return xr.date_range(start,periods=timelen,freq=freq,calendar="360_day",use_cftime=True)
+    if calendar in ("standard","gregorian","proleptic_gregorian"):
+        return pd.date_range(start,periods=timelen,freq=freq)
+    if calendar in ("noleap","365_day"):
+        return _noleap_range(pd.Timestamp(start),timelen,freq)
+    raise ValueError("calendar should be 'standard', 'noleap' or '360_day', not {}".format(calendar))
+
+def _isleap(year):
+    return (year%4==0)&((year%100!=0)|(year%400==0))
+
+def _noleap_range(start,timelen,freq):
+    " Fixed frequency steps in a 365 day calendar, as datetime64 values without Feb 29"
+    try:
+        step=pd.tseries.frequencies.to_offset(freq).nanos
+    except ValueError:
+        # calendar frequencies (months, years) never fall on Feb 29
+        return pd.date_range(start,periods=timelen,freq=freq)
+    if start.month==2 and start.day==29:
+        raise ValueError("{} does not exist in the noleap calendar".format(start.date()))
+
+    doy=start.dayofyear-1-int(start.is_leap_year and start.month>2)
+    elapsed=doy*_day+(start.value%_day)+np.arange(timelen,dtype=np.int64)*step
+    year=start.year+elapsed//(365*_day)
+    elapsed=elapsed%(365*_day)
+    day=elapsed//_day
+    day+=_isleap(year)&(day>=59)
+    first=(year-1970).astype("datetime64[Y]").astype("datetime64[ns]")
+    return first+(day*_day+elapsed%_day).astype("timedelta64[ns]")
+
+def _yearly_files(pattern,years=None):
+    " List of (year, file) for a '{}' or glob pattern, or a list of files, sorted by year"
+    if isinstance(pattern,str) and "{}" in pattern:
+        if years==None:
+            raise ValueError("years are needed with a '{}' pattern")
+        return [(yr,pattern.format(yr)) for yr in years]
+
+    files=[]
+    for f in (glob.glob(pattern) if isinstance(pattern,str) else pattern):
+        found=re.findall(r"(\d{4})",os.path.basename(f))
+        if not found:
+            raise ValueError("No year in the file name {}".format(f))
+        files.append((int(found[-1]),f))
+    if years!=None:
+        years=set(years)
+        files=[(yr,f) for yr,f in files if yr in years]
+    return sorted(files)
+
+
+def _coord_slice(coord,bounds):
+    " Slice selecting bounds=(low,high) whatever the order of the coordinate"
+    lo,hi=min(bounds),max(bounds)
+    if coord.size>1 and coord[0]>coord[-1]:
+        return slice(hi,lo)
+    return slice(lo,hi)
+
+def _select_lon(da,lon):
+    """Select the longitudes from west to east, lazily.
+
+    The bounds can be given in either convention (-180/180 or 0/360), and when
+    west>east once converted to the one of the grid, e.g. (-30,30) or (330,30)
+    on a 0/360 grid, the two sides of the seam are joined, with the longitudes
+    east of it shifted by 360 so that they keep increasing.
+    """
+    west,east=lon
+    values=da.lon.values
+    if values.size<2 or values[0]>values[-1]:
+        return da.sel(lon=_coord_slice(da.lon,lon))
+    if east-west>=360:
+        return da
+    base=-180 if values.min()<0 else 0
+    west,east=(west-base)%360+base,(east-base)%360+base
+    if west<=east:
+        return da.sel(lon=slice(west,east))
+    right=da.sel(lon=slice(None,east))
+    right=right.assign_coords(lon=right.lon+360)
+    if isinstance(da,xr.DataArray):
+        return xr.concat([da.sel(lon=slice(west,None)),right],dim="lon")
+    return xr.concat([da.sel(lon=slice(west,None)),right],dim="lon",
+                     data_vars="minimal",coords="minimal",compat="override")
+
+def _select(da,lat=None,lon=None,level=None,time=None):
+    """Select a region with coordinate slices, lazily.
+
+    Args:
+        da (xarray DataArray): The data with lat and lon coordinates.
+        lat (tuple, optional): (south, north). Defaults to None (all).
+        lon (tuple, optional): (west, east), across the 0/360 seam when west>east,
+            see _select_lon. Defaults to None (all).
+        level (int, optional): Index of the pressure level of 4-D data. Defaults to None (all).
+        time (tuple, optional): (start, end) dates. Defaults to None (all).
+    """
+    if level!=None and da.ndim==4:
+        da=da.isel({da.dims[1]:level})
+    if lat!=None:
+        da=da.sel(lat=_coord_slice(da.lat,lat))
+    if lon!=None:
+        da=_select_lon(da,lon)
+    if time!=None:
+        da=da.sel(time=slice(*time))
+    return da
+
+def _area_mean(da,dims):
+    " Mean over dims in one pass, weighted by cos(lat) when lat is one of them"
+    if "lat" in dims:
+        weights=np.cos(np.deg2rad(da.lat))
+        return da.weighted(weights.astype(da.dtype) if da.dtype.kind=="f" else weights).mean(dims)
+    return da.mean(dims)
+def _season_months(season):
+    """Months of a season.
+
+    Args:
+        season (str or list): The initials of consecutive months, e.g. "DJF" or "JJAS",
+            "ANN" for the whole year, or a list of months, e.g. [12,1,2].
+    """
+    if not isinstance(season,str):
+        return [int(m) for m in season]
+    if season.upper()=="ANN":
+        return list(range(1,13))
+    start=("JFMAMJJASOND"*2).find(season.upper())
+    if start<0 or len(season)>12:
+        raise ValueError("{} is not a season, e.g. 'DJF' or 'JJAS'".format(season))
+    return [(start+k)%12+1 for k in range(len(season))]
+
+def _season_weights(time,seasons):
+    """Indicator weights (season, year, time) of the time steps in every season of every year.
+
+    A season crossing the year boundary, e.g. DJF, belongs to the year of its
+    last month: December 2000 goes to the DJF of 2001.
+    """
+    month=time.dt.month.values
+    year=time.dt.year.values
+    years=np.unique(year)
+    weights=np.zeros((len(seasons),len(years),len(month)))
+    for i,season in enumerate(seasons):
+        months=_season_months(season)
+        wrap=[k for k in range(1,len(months)) if months[k]<months[k-1]]
+        for k,m in enumerate(months):
+            label=year+(1 if wrap and k<wrap[0] else 0)
+            steps=np.nonzero(month==m)[0]
+            rows=np.searchsorted(years,label[steps])
+            keep=(rows<len(years))&(years[np.minimum(rows,len(years)-1)]==label[steps])
+            weights[i,rows[keep],steps[keep]]=1
+    names=[s if isinstance(s,str) else "-".join(str(m) for m in s) for s in seasons]
+    return xr.DataArray(weights,dims=("season","year","time"),
+                        coords={"season":names,"year":years,"time":time})
+
+
+def _cast(ds,dtype):
+    """Cast the floating point data variables to dtype, e.g. float32.
+
+    Dask backed and in-memory variables are cast, lazily for dask. Variables
+    still in a file, e.g. from a plain xr.open_dataset, are chunked first
+    ("auto" chunks) so that they are not read here, and cast as they are read.
+    """
+    dtype=np.dtype(dtype)
+    out=ds.copy()
+    for v,da in ds.data_vars.items():
+        if da.dtype.kind=="f" and da.dtype!=dtype:
+            lazy=da if da.chunks!=None or da.variable._in_memory else da.chunk("auto")
+            out[v]=lazy.astype(dtype)
+            out[v].encoding=da.encoding
+    return out
+
+def _encoding(ds,complevel=4,pack=False,chunk_bytes=4*2**20,packed=None):
+    """netCDF encoding of the numerical data variables of ds.
+
+    The variables are chunked along their first (time) dimension in chunks of
+    about chunk_bytes, whole along the others, and compressed with zlib and
+    the shuffle filter. With pack=True the floating point variables are saved
+    as shorts with scale_factor/add_offset, those of the source file if it was
+    packed, else fitted to the range given in packed.
+
+    Args:
+        ds (xarray Dataset): The data to save.
+        complevel (int, optional): zlib level, 0 disables the compression. Defaults to 4.
+        pack (bool, optional): Pack the floats as int16. Defaults to False.
+        chunk_bytes (int, optional): Target size of the chunks. Defaults to 4 MB.
+        packed (dict, optional): (min, max) of every variable to pack without a source packing. Defaults to None.
+    """
+    encoding={}
+    for v,da in ds.data_vars.items():
+        if da.ndim==0 or da.dtype.kind not in "biuf":
+            continue
+        inner=int(np.prod(da.shape[1:]))*da.dtype.itemsize
+        enc={"zlib":complevel>0,"complevel":complevel,"shuffle":complevel>0,
+             "chunksizes":(max(1,min(da.shape[0],chunk_bytes//max(inner,1))),)+da.shape[1:]}
+        if pack==True and da.dtype.kind=="f":
+            if "scale_factor" in da.encoding and np.dtype(da.encoding.get("dtype","f")).kind=="i":
+                scale,offset=da.encoding["scale_factor"],da.encoding.get("add_offset",0)
+            else:
+                lo,hi=packed[v]
+                scale=(hi-lo)/(2**16-4) if hi>lo else 1.0
+                offset=(hi+lo)/2
+            enc.update({"dtype":"int16","scale_factor":np.float32(scale),"add_offset":np.float32(offset),"_FillValue":np.int16(-32767)})
+        encoding[v]=enc
+    return encoding
+
+def _file_chunks(ds,timecord="time",chunk_bytes=128*2**20):
+    """Default dask chunks of a yearly file: one pressure level, and as many time
+    steps as fit in chunk_bytes, whole along the others. When one time step of a
+    level is already larger (e.g. a fine global grid), it is split along lat too.
+    """
+    levels=("level","lev","plev")
+    chunks={d:(1 if d in levels else -1) for d in ds.dims}
+    step=max([int(np.prod([n for d,n in da.sizes.items() if d!=timecord and d not in levels]))*da.dtype.itemsize
+              for da in ds.data_vars.values() if timecord in da.dims]+[1])
+    if timecord in ds.dims:
+        chunks[timecord]=max(1,min(ds.sizes[timecord],chunk_bytes//step))
+    if step>chunk_bytes and "lat" in ds.dims:
+        chunks["lat"]=max(1,ds.sizes["lat"]*chunk_bytes//step)
+    return chunks
+
+# version of the dataset of every netcdf object, part of the keys of the cached products
+_versions=itertools.count()
 
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 
 class netcdf:
-    def __init__(self,ds,changetime=False,timescale='monthly',start=2000,timecord="time"):
+    def __init__(self,ds,changetime=False,timescale='monthly',start=2000,timecord="time",cache_memory=1024,
+                 store=None,files=None,calendar=None,profile=False,dtype=None):
         """We initialize the module
 
         Args:
             ds (xarray data): Here we pass the data opened by xarray.
             changetime (bool): Sometimes we need to format the datetime of the netcdf to make to suitable for xarray operation.
             Default is False.
+            timescale (str, optional): "monthly", "daily" or a pandas frequency, used with changetime. Defaults to "monthly".
+            start (int or str, optional): First year, or first date, used with changetime. Defaults to 2000.
+            calendar (str, optional): "standard", "noleap" or "360_day", used with changetime.
+            Defaults to "noleap" for daily data and "standard" otherwise.
+            cache_memory (float, optional): Memory cap in MB of the cache of derived products
+            (climatologies, anomalies, annual means), 0 disables it. Defaults to 1024.
+            store (str or ProductStore, optional): Directory where the climatologies and annual
+            means are saved and reused across sessions. Defaults to None.
+            files (list, optional): Source files of ds, used to fingerprint the stored products.
+            Defaults to the file ds was opened from.
+            profile (bool or Profiler, optional): Record the time, bytes read, peak memory and shape
+            of every analysis, plot and save call, see _set_profiling. Defaults to False.
+            dtype (str, optional): Precision of the computations, e.g. "float32" halves the memory of
+            float64 data, see _cast. Defaults to None (as read).
         """
 
+        self.profiler=Profiler() if profile is True else (profile if isinstance(profile,Profiler) else None)
         self.ds=ds
         self.changetime=changetime
         self.start=start
         self.timecord=timecord
+        self.cache=ProductCache(cache_memory)
+        self.store=ProductStore(store) if isinstance(store,str) else store
+        self.files=files
+        self.execution=None
 
         if changetime ==True:
+            time=_make_time(self.ds.sizes[f"{timecord}"],start,timescale,calendar)
+            self.ds=self.ds.assign_coords({f"{timecord}":time})
+            if self.timecord!="time":
+                self.ds=self.ds.rename(name_dict={f"{timecord}":"time"})
+        if dtype!=None:
+            self.ds=_cast(self.ds,dtype)
+        self._modified=False
+
+    @property
+    def ds(self):
+        """The dataset. Assigning a new one, e.g. nc.ds=nc.ds-273.15, invalidates the cached
+        products, and the products are no longer read from or saved to the store."""
+        return self._ds
+
+    @ds.setter
+    def ds(self,ds):
+        self._ds=ds
+        self._version=next(_versions)
+        self._modified=True
+        if "cache" in self.__dict__:
+            self.cache.invalidate()
+
+    def _update_ds(self,ds):
+        " Replace the dataset by the same data, rechunked, loaded or a selection of it, keeping the store valid"
+        modified=self._modified
+        self.ds=ds
+        self._modified=modified
+
+    @classmethod
+    def from_files(cls,pattern,years=None,chunks=None,changetime=False,timescale="monthly",
+                   timecord="time",calendar=None,parallel=True,**kwargs):
+        """Open yearly files, as written by get_data, as one lazy dask backed dataset.
+
+        Nothing is loaded: the files are opened in parallel, concatenated along
+        time and chunked, so the analysis runs out-of-core. With changetime=True
+        the time axis of every file is rebuilt from its year, as in __init__.
+
+        Args:
+            pattern (str or list): Either a pattern with "{}" replaced by each year, e.g. "path/hgt_{}.nc",
+                a glob pattern, e.g. "path/hgt_*.nc", or a list of files with the year in their names.
+            years (iterable, optional): Years to open. Needed with "{}", with a glob pattern
+                it selects among the files found. Defaults to None.
+            chunks (dict, optional): Chunks of each file. Defaults to one pressure level and
+                chunks of at most about 128 MB, split along time then lat, see _file_chunks.
+            changetime (bool, optional): Rebuild the time of each file from its year. Defaults to False.
+            timescale (str, optional): "monthly", "daily" or a pandas frequency, used with changetime. Defaults to "monthly".
+            timecord (str, optional): Name of the time coordinate in the files. Defaults to "time".
+            calendar (str, optional): Calendar of the rebuilt time, see __init__. Defaults to None.
+            parallel (bool, optional): Open the files in parallel with dask. Defaults to True.
+            **kwargs: passed to netcdf, e.g. store, cache_memory or profile.
+        """
+        profile=kwargs.get("profile")
+        kwargs["profile"]=Profiler() if profile is True else (profile if isinstance(profile,Profiler) else None)
+        files=_yearly_files(pattern,years)
+        if len(files)==0:
+            raise FileNotFoundError("No file matches {}".format(pattern))
+
+        if chunks==None:
+            with xr.open_dataset(files[0][1]) as first:
+                chunks=_file_chunks(first,timecord)
+
+        source_year={os.path.abspath(f):yr for yr,f in files}
+
+        def _fix_time(ds):
+            if changetime==True:
+                year=source_year[os.path.abspath(ds.encoding["source"])]
+                ds=ds.assign_coords({timecord:_make_time(ds.sizes[timecord],year,timescale,calendar)})
+            if timecord!="time":
+                ds=ds.rename(name_dict={timecord:"time"})
+            return ds
+
+        with recording(kwargs.get("profile"),"from_files","load"):
+            ds=xr.open_mfdataset([f for _,f in files],chunks=chunks,preprocess=_fix_time,
+                                 combine="nested",concat_dim="time",parallel=parallel,
+                                 data_vars="minimal",coords="minimal",compat="override")
+        return cls(ds,start=files[0][0],files=[f for _,f in files],**kwargs)
+
+    @classmethod
+    def from_catalog(cls,catalog,variables=None,time=None,level=None,lat=None,lon=None,**kwargs):
+        """Open only the files of a catalogued directory holding the data asked for, and subset them lazily.
 
-            if timescale=="monthly":
-                timelen=len(self.ds[f"{timecord}"])
-                end=start+int((timelen/12)-1)
-                a="{}-01-01".format(start)  
-                b="{}-12-01".format(end)
-                a=pd.to_datetime(a)
-                b=pd.to_datetime(b)
-                user_date_range = pd.date_range(start=a,end=b,freq="MS")
-                self.ds[f"{timecord}"]=user_date_range
-                if self.timecord!="time":
-                    self.ds=self.ds.rename(name_dict={f"{timecord}":"time"})
+        Args:
+            catalog (str or Catalog): The directory, or its Catalog (refreshed when it is opened).
+            variables (list, optional): Variables to keep. Defaults to None (all).
+            time (str or tuple, optional): A date or period, e.g. "2001-02", or (start, end). Defaults to None (all).
+            level (float or tuple, optional): Pressure level value(s), see _subset. Defaults to None (all).
+            lat (tuple, optional): (south, north). Defaults to None (all).
+            lon (tuple, optional): (west, east), see _subset. Defaults to None (all).
+            **kwargs: passed to from_files, e.g. changetime or chunks.
+        """
+        from catalog import Catalog, _bounds
+
+        if isinstance(catalog,str):
+            catalog=Catalog(catalog)
+        files=catalog.query(variables,time,level,lat,lon)
+        if len(files)==0:
+            raise FileNotFoundError("No file of {} holds the data asked for".format(catalog.path))
+        nc=cls.from_files(files,**kwargs)
+        if variables!=None:
+            nc._update_ds(nc.ds[variables])
+        if time!=None:
+            time=tuple(t[:19] for t in _bounds(time))
+        if all(x==None for x in (time,level,lat,lon)):
+            return nc
+        return nc._subset(lat,lon,level,time)
+
+    @profiled("load")
+    def _set_execution(self,lazy=True,scheduler="threads",workers=None,memory_limit=None,chunks=None):
+        """Choose how the reductions run.
+
+        In lazy mode the dataset is dask backed, every analysis method returns
+        lazy results, and they are only computed, on the chosen local scheduler,
+        when a plot is drawn, a file is saved or _compute is called.
 
-            if timescale=="daily":
+        Args:
+            lazy (bool, optional): Out-of-core dask mode, False loads the dataset in memory. Defaults to True.
+            scheduler (str, optional): "threads", "processes" or "synchronous". Defaults to "threads".
+            workers (int, optional): Number of workers. Defaults to the number of cores.
+            memory_limit (int or str, optional): Memory for the whole computation, e.g. "8GB".
+                The dataset is rechunked so that every worker holds a few chunks within it. Defaults to None.
+            chunks (dict or str, optional): Chunks of the dataset. Defaults to "auto" if it is not
+                dask backed yet or memory_limit is given, else the chunks are kept.
+        """
+        import dask
+        from dask.utils import parse_bytes
+
+        if scheduler not in ("threads","processes","synchronous"):
+            raise ValueError("scheduler should be 'threads', 'processes' or 'synchronous', not {}".format(scheduler))
+        workers=workers if workers!=None else os.cpu_count()
+
+        if lazy==True:
+            config={}
+            if memory_limit!=None:
+                limit=parse_bytes(memory_limit) if isinstance(memory_limit,str) else int(memory_limit)
+                config["array.chunk-size"]=max(1,limit//(4*workers))
+            if chunks!=None or memory_limit!=None or not self.ds.chunks:
+                with dask.config.set(config):
+                    self._update_ds(self.ds.chunk(chunks if chunks!=None else "auto"))
+            self.execution={"scheduler":scheduler,"num_workers":workers}
+        else:
+            self._update_ds(self.ds.load())
+            self.execution=None
+        self.cache.invalidate()
+        return self
+
+    def _set_profiling(self,enabled=True,callback=None,memory=True):
+        """Turn the instrumentation of the analysis, plot and save methods on or off.
 
-                a="{}-01-01".format(start)
-                endyear=start+int(len(self.ds[f"{timecord}"])/365)-1 
-                b="{}-12-31".format(endyear)
+        Every call records its method, phase ("load", "compute", "render" or "save"),
+        nesting depth, wall time, bytes read by the process, peak memory and result
+        shape. Use self.profiler.report() for all the events as a DataFrame, or
+        self.profiler.summary() for the totals per phase and method. When it is off
+        the methods run as if they were not instrumented.
 
-                df=pd.DataFrame({"Date":pd.date_range(a,b,freq="D")})
-                #df.set_index("Date",inplace=True)
+        Args:
+            enabled (bool, optional): Turn profiling on or off. Defaults to True.
+            callback (callable, optional): Called with every event, e.g. to log it. Defaults to None.
+            memory (bool, optional): Record the peak memory with tracemalloc, which slows down
+                allocations. Defaults to True.
+
+        Returns:
+            Profiler: The new profiler, or None when turned off.
+        """
+        if self.profiler!=None:
+            self.profiler.stop()
+        self.profiler=Profiler(callback,memory) if enabled==True else None
+        return self.profiler
+
+    def _scheduler(self):
+        " Context in which the dask computations run"
+        if self.execution==None:
+            return contextlib.nullcontext()
+        import dask
+        return dask.config.set(**self.execution)
+
+    @profiled("compute")
+    def _compute(self,data):
+        " Materialize a lazy result on the chosen scheduler"
+        if not hasattr(data,"compute"):
+            return data
+        with self._scheduler():
+            return data.compute()
+
+    def _time_range(self):
+        " Identifies the data behind the cached products"
+        time=self.ds["time"].values if "time" in self.ds.coords else []
+        if len(time)==0:
+            return ()
+        return (str(time[0]),str(time[-1]),len(time))
+
+    def _source_files(self):
+        " The files behind self.ds, empty if they are not known"
+        if self.files!=None:
+            return list(self.files)
+        source=self.ds.encoding.get("source")
+        return [source] if source!=None and os.path.exists(source) else []
+
+    def _clear_cache(self,product=None,var=None):
+        """Invalidate the cached derived products, e.g. after modifying self.ds in place.
+        The store cannot see such changes, so from then on the products are no longer
+        read from or saved to it. Assigning self.ds does all this by itself.
+
+        Args:
+            product (str, optional): Only clear this method, e.g. "_mon_climatology". Defaults to None (all).
+            var (str, optional): Only clear the products of this variable. Defaults to None (all).
+        """
+        self.cache.invalidate(product,var)
+        self._modified=True
+
+    def _subset(self,lat=None,lon=None,level=None,time=None):
+        """A netcdf object restricted to a region, pressure levels and dates.
+
+        The selection is lazy: on a dataset opened from files (from_files or
+        xr.open_dataset) only the selected hyperslabs are read from the files when
+        the data is used, e.g. a regional study at 850 hPa reads a few MB and not
+        the whole global file. The settings (execution, store, profiler) are kept,
+        with a new cache.
+
+        Args:
+            lat (tuple, optional): (south, north). Defaults to None (all).
+            lon (tuple, optional): (west, east), in the -180/180 or 0/360 convention. With west>east,
+                e.g. (330,30) or (-30,30), the region crosses the 0/360 seam. Defaults to None (all).
+            level (float, tuple or list, optional): Pressure level values (not indices): one level,
+                (bottom, top) or a list. The level dimension is kept, so use lv=0 and dim=4
+                afterwards. Defaults to None (all).
+            time (tuple or str, optional): (start, end) dates, or one period, e.g. "2000". Defaults to None (all).
+
+        Returns:
+            netcdf: the subset.
+        """
+        ds=self.ds
+        if level!=None:
+            name=[d for d in ("level","lev","plev") if d in ds.dims]
+            if not name:
+                raise ValueError("The dataset has no pressure level dimension")
+            if isinstance(level,tuple):
+                ds=ds.sel({name[0]:_coord_slice(ds[name[0]],level)})
+            else:
+                ds=ds.sel({name[0]:np.atleast_1d(level)})
+        if time!=None:
+            ds=ds.sel(time=slice(*time) if isinstance(time,tuple) else time)
+        ds=_select(ds,lat=lat,lon=lon)
+
+        out=copy.copy(self)
+        out.cache=ProductCache(self.cache.max_bytes/2**20)
+        out._update_ds(ds)
+        return out
+
+    @profiled("load")
+    def _array_cache(self,var,path=None):
+        """A memory-mapped copy of a variable, time contiguous per grid point, see array_cache.
+
+        The variable is written once, uncompressed, with time as the last
+        dimension, and then mapped: the kernels get views of it instead of
+        copies, and worker processes that open the same file share the data
+        through the page cache. When the source files are known the file is
+        reused by later calls and sessions until they change. A dataset modified
+        in memory (see the ds property) gets a file of its own, written again
+        every call, like the store is skipped for its products.
+
+        Args:
+            var (str): variable name. Use _subset first for a region or some levels.
+            path (str, optional): Directory of the cache. Defaults to the store, or a
+                "pyclim_array_cache" directory in the temporary directory.
 
-                dg = df[~((df.Date.dt.month == 2) & (df.Date.dt.day == 29))]
+        Returns:
+            xarray DataArray: read-only, dims (..., lat, lon, time), backed by a numpy memmap.
+            Its file is in .encoding["source"].
+        """
+        import array_cache
+
+        if path==None:
+            path=self.store.path if self.store!=None else os.path.join(tempfile.gettempdir(),"pyclim_array_cache")
+        files=self._source_files() if not self._modified else []
+        fp=fingerprint("_array_cache",(("var",var),),self.ds[[var]],files,self._time_range())
+        if files:
+            filename=os.path.join(path,"{}_{}.npy".format(var,fp[:16]))
+        else:
+            filename=os.path.join(path,"{}_{}_{}_{}.npy".format(var,fp[:16],os.getpid(),self._version))
+        if not files or not os.path.exists(filename):
+            with self._scheduler():
+                array_cache.write_cache(self.ds[f"{var}"],filename)
+        da=array_cache.open_cache(filename)
+        da.encoding["source"]=filename
+        return da
+
+    @profiled("compute")
+    def _apply_gridpoint(self,func,var,workers=None,tile=None,block=False,dim="output",path=None):
+        """Apply a function to every grid point time series, across a process pool.
+
+        For the per-point analyses that do not vectorize, e.g. a scipy.stats test
+        or a scikit-learn fit. The variable goes through _array_cache, the domain is
+        split in lat/lon tiles and the workers read and write memory-mapped files,
+        see gridpoint.apply_gridpoint.
 
-                self.ds[f"{timecord}"]=dg.Date.values
-                if self.timecord!="time":
-                    self.ds=self.ds.rename(name_dict={f"{timecord}":"time"})
+        Args:
+            func (callable): A module level function of one time series returning a number or
+                a 1-D array, or with block=True of a 2-D array (points, time) returning one row per point.
+            var (str): variable name. Use _subset first for a region or some levels.
+            workers (int, optional): Number of processes. Defaults to the number of cores.
+            tile (tuple, optional): (lat, lon) size of the tiles. Defaults to latitude bands.
+            block (bool, optional): Call func on blocks of points. Defaults to False.
+            dim (str, optional): Name of the output dimension of array results. Defaults to "output".
+            path (str, optional): Directory of the array cache, see _array_cache. Defaults to None.
+
+        Returns:
+            xarray DataArray: the results on the (level,) lat, lon grid.
+        """
+        import gridpoint
 
+        return gridpoint.apply_gridpoint(self._array_cache(var,path),func,workers,tile,block,dim)
 
     def _datadetails(self):
         "This methods provide a comprehensive details of the data"
         print(self.ds)
 
-    def _return_ds(self,pathname="./file.nc",save=False):
+    @profiled("save")
+    def _return_ds(self,pathname="./file.nc",save=False,complevel=4,pack=False):
         """This method returns and saves the netcdf file.
 
+        The file is chunked along time and compressed, see _encoding, and written
+        atomically.
+
         Args:
             pathname (str, optional):Provide the path and file name in this format. Defaults to "./file.nc".
-
+            complevel (int, optional): zlib level, 0 writes it uncompressed. Defaults to 4.
+            pack (bool, optional): Save the floats as shorts with scale_factor/add_offset,
+            reusing the packing of the source file when there is one. Defaults to False.
         """
         if save==True:
-            self.ds.to_netcdf(pathname)
+            packed={}
+            need=[v for v,da in self.ds.data_vars.items() if da.dtype.kind=="f" and "scale_factor" not in da.encoding]
+            if pack==True and need:
+                # the ranges of all the variables in one pass over the data
+                bounds=self._compute(xr.concat([self.ds[need].min(),self.ds[need].max()],dim="bound"))
+                packed={v:(float(bounds[v][0]),float(bounds[v][1])) for v in need}
+            encoding=_encoding(self.ds,complevel,pack,packed=packed)
+            tmp=pathname+".tmp"
+            with self._scheduler():
+                self.ds.to_netcdf(tmp,encoding=encoding)
+            os.replace(tmp,pathname)
         return self.ds
 
-    def _plotdata(data,lat,lon,central_longitude=180,figsize=(7.5,5.5),size=14,
-                  fontfamily="sans-serif",extent=None,cmap="jet",cextend="both",
-                  clim=None,clevel=20,title=None,cbar_label=None,cbar_position="vertical",
-                  savefig=False,savefigpath=None,savefigname="fig",
-                  svformat=".png",dpi=300,nan=False,land=True):
-        """This function plots the netcdf file
+    def _plotdata(*args,**kwargs):
+        " Plot a 2-D field on a map, see netcdf_plotting._plotdata"
+        return _plotting()._plotdata(*args,**kwargs)
+
+    @profiled("render")
+    def _plot_with_xarray(self,*args,**kwargs):
+        " Plot a variable for a particular date, pressure level, see netcdf_plotting._plot_with_xarray"
+        return _plotting()._plot_with_xarray(self,*args,**kwargs)
+
+    @profiled("compute")
+    @cached(persist=True)
+    def _mon_climatology(self):
+        " This code computes the monthly climatology of the dataset"
+        return self.ds.groupby('time.month').mean('time')
+    
+    @profiled("compute")
+    def _climatology_accumulator(self,group="month",leap="feb28"):
+        """The climatology as a mergeable accumulator (count, sum and sum of squares per group).
+
+        It can be saved, and later years added or removed without reprocessing
+        the whole record, see streaming_climatology.
 
         Args:
-            figsize (tuple, optional): _description_. Defaults to (7.5,5.5).
-            title (str, optional): set the title of the plot . Defaults to None.
-            cbar_label (str, optional): set the label of the colorbar. Defaults to None.
-            savefig (bool, optional): to save the figure. Defaults to False.
-            savefigpath (str, optional): destination of the plot to save. Defaults to None.
-            format(str,optional): The format of the plot to be saved. Defaults to .png
+            group (str, optional): "month" or "dayofyear". Defaults to "month".
+            leap (str, optional): Leap day handling of the day-of-year groups. Defaults to "feb28".
         """
+        from streaming_climatology import ClimatologyAccumulator
+        return ClimatologyAccumulator(group,leap).add(self.ds)
 
-        latitude=lat
-        longitude=lon
-        ticksize=size
-        fontsize=size+2
-        #data=self.ds.values
-        #if fontfamily==None:
-        #    plt.rcParams["font.family"]="sans-serif"
-        #else:
-        plt.rcParams["font.family"]=fontfamily
-        plt.rcParams["font.size"]=size
-        if clim==None:
-            lv=np.linspace(np.percentile(data,25),np.percentile(data,75),15)
-        else:
-            lv=np.linspace(clim[0],clim[1],clevel)
-        
-        fig, ax = plt.subplots(subplot_kw={'projection': ccrs.PlateCarree(central_longitude)},figsize=figsize)
-
-        if extent ==None:
-            ax.set_extent([min(longitude),max(longitude),min(latitude),max(latitude)],crs=ccrs.PlateCarree())
-        if extent!=None:
-            ax.set_extent(extent,crs=ccrs.PlateCarree())
-
-        mm = ax.contourf(longitude,latitude,data,transform=ccrs.PlateCarree(),\
-                 levels=lv,\
-                 cmap=cmap,extend=cextend)
-        if nan==True:
-            if len(np.isnan(data))>=0:
-                xmin, xmax = ax.get_xlim()
-                ymin, ymax = ax.get_ylim()
-                xy = (xmin,ymin)
-                width = xmax - xmin
-                height = ymax - ymin
-                p = patches.Rectangle(xy, width, height, hatch='/', fill=None, zorder=-2)
-                ax.add_patch(p)
-        ax.coastlines(resolution='110m')
-        #ax.add_feature(cfeature.OCEAN.with_scale('110m'),zorder=2)
-        ax.add_feature(cfeature.BORDERS.with_scale('50m'))
-        ax.add_feature(cfeature.STATES)
-        if land==True:
-            ax.add_feature(cfeature.LAND,zorder=2)
-        gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                        linewidth=1, color='gray', alpha=0.5, linestyle='--')
-        #gl.xlabels_top = False
-        gl.top_labels = False
-        gl.right_labels = False
-        gl.xformatter = LONGITUDE_FORMATTER
-        gl.yformatter = LATITUDE_FORMATTER
-
-        im_ratio = data.shape[0]/data.shape[1]
-        cb = plt.colorbar(mm, shrink=0.9,orientation=cbar_position, drawedges='True',pad=0.03,fraction=0.04*im_ratio,ticks=lv[::2],format="%3.1f")
-        cb.ax.tick_params(size=10,labelsize=ticksize-2)
-        if cbar_label!=None:
-            cb.set_label(label=cbar_label,size=size-2)
-
-        if title!=None:
-            ax.set_title(title,fontsize=size)
-        
-        if savefig==True:
-            
-            #print("As the savefigname is not given, so it saves as fig")
-            #plt.savefig(savefigpath+savefigname+svformat,dpi=dpi,bbox_inches="tight")
-            plt.savefig(savefigpath+savefigname+svformat,dpi=dpi,bbox_inches="tight")
-        plt.show()
+    @profiled("render")
+    def _plot_monthly_climatology(self,*args,**kwargs):
+        " We plot the monthly climatology, see netcdf_plotting._plot_monthly_climatology"
+        return _plotting()._plot_monthly_climatology(self,*args,**kwargs)
 
-## We plot the data using xarray inbuilt function
-    def _plot_with_xarray(self,var,level=0,dim=3,timestamp=0,clim=None,clevels=None,cmap='jet'):
-        """By calling this method, one can plot the file for a particular date, pressure level
+    @profiled("render")
+    def _render_maps(self,var,outpattern,level=0,dim=3,product="data",frames=None,
+                     clim=None,clevel=20,workers=1,fps=4,**template):
+        """Render many maps of a variable without the per-plot setup cost.
+
+        The map template (projection, coastlines, borders, land, colorbar) is
+        built once per worker and only the contours change from one frame to
+        the next. Nothing is shown, the frames are written to files.
 
         Args:
             var (str): variable name
+            outpattern (str): e.g. "maps/air_{:03d}.png", formatted with the frame number,
+                or a single ".gif"/".mp4" file for an animation.
             level (int, optional): Pressure level. Defaults to 0.
             dim (int, optional): If the dataset has multiple levels then change dim=4. Defaults to 3.
-            timestamp (int, optional): The time we want to visulize. Defaults to 0.
-            clim (_type_, optional): colorbar limit, should be a list/array, e.g., [low,high]. Defaults to None.
-            clevels (_type_, optional): No of levels in the colorbar. Defaults to None.
-            cmap (str, optional): colormap. Defaults to 'jet'.
+            product (str, optional): "data", "monthly_climatology", "monthly_anomaly" or "daily_anomaly". Defaults to "data".
+            frames (list, optional): Indices of the frames to render. Defaults to all.
+            clim (list, optional): colorbar limits [low,high], shared by all frames. Defaults to the 2-98 percentiles.
+            clevel (int, optional): Number of contour levels. Defaults to 20.
+            workers (int, optional): Number of processes rendering frames. Defaults to 1.
+            fps (int, optional): frames per second of an animation. Defaults to 4.
+            **template: passed to map_renderer.MapRenderer, e.g. cmap, extent or cbar_label.
+
+        Returns:
+            list: the files written.
         """
-
-        ds=self.ds
-        if dim==3:
-            da=ds[f"{var}"][timestamp,:,:]
+        import map_renderer
+
+        if product=="data":
+            da=self.ds[f"{var}"]
+        elif product=="monthly_climatology":
+            da=self._mon_climatology()[f"{var}"]
+        elif product=="monthly_anomaly":
+            da=self._monthly_anomaly()[f"{var}"]
+        elif product=="daily_anomaly":
+            da=self._daily_anomaly(var,lv=level,dim=dim)[f"{var}"]
+            dim=3
+        else:
+            raise ValueError("Unknown product {}".format(product))
         if dim==4:
-            da=ds[f"{var}"][timestamp,level,:,:]
-        if clevels==None:
-            levels=20
-        plt.figure(figsize=(7.5,4.5),constrained_layout=True)
-        ax = plt.axes(projection=ccrs.PlateCarree())
-        ax.coastlines(resolution='110m') 
-        #ax.add_feature(cfeature.LAND,zorder=2)
-        
-        plot_kwargs={"orientation": "horizontal","fraction":0.12,
-                     'pad':0.03,'aspect':40}
-        if clim==None:
-            da.plot(levels=30,\
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-        if clim !=None:
-            da.plot(levels=30,vmin=clim[0],vmax=clim[1],
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-    
-        plt.show()
+            da=da[:,level]
+        if frames!=None:
+            da=da.isel({da.dims[0]:list(frames)})
+        da=self._compute(da)
 
-    def _mon_climatology(self):
-        " This code computes the monthly climatology of the dataset"
-        return self.ds.groupby('time.month').mean('time')
-    
-    def _plot_monthly_climatology(self,var,level=0,dim=3,mon=0,clim=None,levels=None,cmap='jet'):
-        " We plot the monthly climatology"
-        dm=self._mon_climatology()
-        if dim==3:
-            da=dm[f"{var}"][mon-1,:,:]
-        if dim==4:
-            da=dm[f"{var}"][mon-1,level,:,:]
-        
-        if levels==None:
-            levels=20
         months=["Jan","Feb","March","April","May","June","July","Aug","Sep","Oct","Nov","Dec"]
-        plt.figure(figsize=(7.5,4.5),constrained_layout=True)
-        ax = plt.axes(projection=ccrs.PlateCarree())
-        ax.coastlines(resolution='110m') 
-        ax.add_feature(cfeature.LAND,zorder=2)
-        
-        plot_kwargs={"orientation": "horizontal","fraction":0.12,
-                     'pad':0.03,'aspect':40}
-        if clim==None:
-            da.plot(levels=30,\
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-        if clim !=None:
-            da.plot(levels=30,vmin=clim[0],vmax=clim[1],
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-
-        ax.set_title("Monthly climatology of {} for month {}".format(var,months[mon-1]),fontsize=16)
-        plt.show()
-
+        if da.dims[0]=="month":
+            titles=["{} {}".format(var,months[m-1]) for m in da.month.values]
+        else:
+            titles=["{} {}".format(var,str(t)[:10]) for t in da[da.dims[0]].values]
+
+        if outpattern.endswith((".gif",".mp4")):
+            levels=map_renderer._levels(da.values,clim,clevel)
+            renderer=map_renderer.MapRenderer(da.lon,da.lat,levels,**template)
+            renderer.animate(da.values,outpattern,titles,fps=fps)
+            return [outpattern]
+        outfiles=[outpattern.format(i) for i in range(da.shape[0])]
+        return map_renderer.render_batch(da.lon,da.lat,da.values,outfiles,titles,clim=clim,
+                                         clevel=clevel,workers=workers,**template)
+
+    @profiled("compute")
+    @cached(persist=True)
     def _mean_seasonal_climatology(self,season="DJF"):
-        
+        """The climatological mean of a season, from the cached monthly climatology.
+        For the means of every year see _seasonal_means.
+
+        Args:
+            season (str or list, optional): "DJF", "JJAS", "ANN"... or a list of months. Defaults to "DJF".
+        """
         ds=self._mon_climatology()
-        if season=="DJF":
-            season_data=ds.sel(month=ds.month.isin([12,1,2]))
-        if season=="MAM":
-            season_data=ds.sel(month=ds.month.isin([3,4,5]))
-        if season=="JJA":
-            season_data=ds.sel(month=ds.month.isin([6,7,8]))
-        if season=="SON":
-            season_data=ds.sel(month=ds.month.isin([9,10,11]))
+        months=[m for m in _season_months(season) if m in ds.month.values]
+        return ds.sel(month=months).mean('month')
+
+    def _monthly_sums(self):
+        " Sum and number of valid values of every month, in one pass (a no-op reduction for monthly data)"
+        ds=self.ds[[v for v in self.ds.data_vars if "time" in self.ds[v].dims]]
+        months=ds.resample(time="MS")
+        return months.sum("time"),months.count("time")
+
+    @profiled("compute")
+    @cached
+    def _seasonal_means(self,seasons=("DJF","MAM","JJA","SON"),complete=True):
+        """Mean of every season of every year, for any number of seasons, in one pass.
+
+        The data is reduced once to monthly sums and counts, and every season of
+        every year is then a weighted sum of those months, all computed together as
+        one product with a (season, year, month) weight array, so adding seasons
+        costs almost nothing. Seasons crossing the year boundary, like DJF, are
+        labelled by the year of their last month.
+
+        Args:
+            seasons (tuple, optional): Seasons such as "DJF", "JJAS", "ANN" or tuples of months,
+                e.g. (11,12,1). Defaults to ("DJF","MAM","JJA","SON").
+            complete (bool, optional): NaN for the seasons with a month missing, e.g. the first DJF.
+                Defaults to True.
 
-        return season_data.mean('month')
+        Returns:
+            xarray Dataset: the means, with season and year dimensions.
+        """
+        total,count=self._monthly_sums()
+        weights=_season_weights(total.time,list(seasons))
+        def _dot(ds):
+            return ds.map(lambda da: xr.dot(weights,da,dim="time"))
+        out=_dot(total)/_dot(count)
+        if complete==True:
+            present=_dot((count>0).astype("int64"))
+            size=xr.DataArray([len(_season_months(s)) for s in seasons],dims="season")
+            out=out.where(present==size)
+        for v in out.data_vars:
+            out[v]=out[v].astype(self.ds[v].dtype) if self.ds[v].dtype.kind=="f" else out[v]
+        return out
+
+    @profiled("compute")
+    def _running_mean(self,window,monthly=True,center=False):
+        """Running mean over window months (or time steps), with a cumulative sum kernel.
+
+        The cost does not depend on the window: every mean is the difference of
+        two cumulative sums. Windows with missing values are NaN.
 
+        Args:
+            window (int): Length of the window.
+            monthly (bool, optional): Over monthly means (of daily data, say), False uses
+                the time steps of the data. Defaults to True.
+            center (bool, optional): Label the windows by their center instead of their last step.
+                Defaults to False.
+        """
+        if monthly==True:
+            total,count=self._monthly_sums()
+        else:
+            ds=self.ds[[v for v in self.ds.data_vars if "time" in self.ds[v].dims]]
+            total,count=ds.fillna(0),ds.notnull().astype("int64")
+        def _window(x):
+            cum=x.astype("float64").cumsum("time")
+            return cum-cum.shift(time=window,fill_value=0)
+        out=(_window(total)/_window(count)).where(_window(count>0)==window)
+        for v in out.data_vars:
+            out[v]=out[v].astype(self.ds[v].dtype) if self.ds[v].dtype.kind=="f" else out[v]
+        if center==True:
+            out=out.shift(time=-(window//2))
+        return out
+
+    @profiled("compute")
+    @cached
     def _monthly_anomaly (self):
         return self.ds.groupby('time.month') - self._mon_climatology()
 
-    def _plot_monthly_anomaly(self,var,level=0,dim=3,timestamp=0,clim=None,levels=None,cmap='jet'):
+    @profiled("render")
+    def _plot_monthly_anomaly(self,*args,**kwargs):
+        " We plot the monthly anomaly, see netcdf_plotting._plot_monthly_anomaly"
+        return _plotting()._plot_monthly_anomaly(self,*args,**kwargs)
 
-        dm=self._monthly_anomaly()
-        if dim==3:
-            da=dm[f"{var}"][timestamp,:,:]
-        if dim==4:
-            da=dm[f"{var}"][timestamp,level,:,:]
-        
-        if levels==None:
-            levels=20
-        plt.figure(figsize=(7.5,4.5),constrained_layout=True)
-        ax = plt.axes(projection=ccrs.PlateCarree())
-        ax.coastlines(resolution='110m') 
-        ax.add_feature(cfeature.LAND,zorder=2)
-        
-        plot_kwargs={"orientation": "horizontal","fraction":0.12,
-                     'pad':0.03,'aspect':40}
-        if clim==None:
-            da.plot(levels=30,\
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-        if clim !=None:
-            da.plot(levels=30,vmin=clim[0],vmax=clim[1],
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    @profiled("compute")
+    @cached(persist=True)
+    def _daily_climatology(self,var,lv=0,dim=3,leap="feb28",smooth=None,nharm=3,window=31):
+        """Compute the day-of-year climatology of a variable.
 
-        ax.set_title("Monthly anomaly of {}".format(var),fontsize=14)
-        plt.show()
+        The days are grouped by calendar day (month and day), so leap years and
+        partial years are handled and the data is never copied or reshaped.
+        Dask backed data stays lazy.
 
-    # def _daily_climatology(self):
-    #     return self.ds.groupby('time.day').mean('time')   
+        Args:
+            var (str): variable name
+            lv (int, optional): Pressure level. Defaults to 0.
+            dim (int, optional): If the dataset has multiple levels then change dim=4. Defaults to 3.
+            leap (str, optional): "feb28" uses the Feb 28 climatology for Feb 29,
+                "separate" keeps Feb 29 as its own day. Defaults to "feb28".
+            smooth (str, optional): None, "harmonic" (first nharm harmonics of the annual cycle)
+                or "running" (centered running mean of window days). Defaults to None.
+            nharm (int, optional): Number of harmonics for smooth="harmonic". Defaults to 3.
+            window (int, optional): Window in days for smooth="running". Defaults to 31.
+
+        Returns:
+            xarray DataArray: the climatology with a "dayofyear" dimension.
+        """
+        da=self.ds[f"{var}"]
+        if dim==4:
+            da=da[:,lv]
+        clim=da.groupby(_dayofyear(da.time,leap)).mean("time")
+
+        period=360 if da.time.dt.calendar=="360_day" else 366
+        if smooth=="harmonic":
+            clim=_harmonic_smooth(clim,nharm,period)
+        elif smooth=="running":
+            half=window//2
+            clim=clim.pad(dayofyear=half,mode="wrap").rolling(dayofyear=window,center=True,min_periods=1).mean()
+            clim=clim.isel(dayofyear=slice(half,clim.sizes["dayofyear"]-half))
+        elif smooth!=None:
+            raise ValueError("smooth should be None, 'harmonic' or 'running', not {}".format(smooth))
+        return clim
+
+    @profiled("compute")
+    @cached
+    def _daily_anomaly(self,var,lat=None,lon=None,lv=0,dim=3,leap="feb28",smooth=None,nharm=3,window=31):
+        """Compute the daily anomaly with respect to the day-of-year climatology.
+
+        See _daily_climatology for the grouping, leap day and smoothing options.
+        lat and lon are not needed anymore, the coordinates of the dataset are kept.
 
+        Args:
+            var (str): variable name
+            lv (int, optional): Pressure level. Defaults to 0.
+            dim (int, optional): If the dataset has multiple levels then change dim=4. Defaults to 3.
 
-    # def _daily_anomaly(self):
-    #     return self.ds.groupby("time.day")-self._daily_climatology()
+        Returns:
+            xarray Dataset: the anomaly, with the same variable name and coordinates.
+        """
+        da=self.ds[f"{var}"]
+        if dim==4:
+            da=da[:,lv]
+        clim=self._daily_climatology(var,lv,dim,leap,smooth,nharm,window)
+        anomaly=(da.groupby(_dayofyear(da.time,leap))-clim).drop_vars("dayofyear")
+        anomaly.attrs=da.attrs
+        return anomaly.to_dataset(name=f"{var}")
 
+    @profiled("compute")
+    def _correlate(self,var,other,othervar=None,level=0,dim=3,lag=0,siglevel=None,max_memory=256):
+        """Correlation and regression of two fields at every grid point.
 
+        The statistics of all grid points are computed together with numpy
+        reductions, latitude block by latitude block so that only about
+        ``max_memory`` MB are in memory at once. The two series are matched by
+        position along time; NaNs are masked pair by pair.
 
-    def _daily_anomaly(self,var,lat,lon,lv=0,dim=3):
+        Args:
+            var (str): variable name, the predictor x.
+            other (netcdf, xarray Dataset or DataArray): The predictand y. It can be
+                a field on the same grid or a single time series (an index).
+            othervar (str, optional): variable name in other. Defaults to var.
+            level (int, optional): Pressure level. Defaults to 0.
+            dim (int, optional): If the dataset has multiple levels then change dim=4. Defaults to 3.
+            lag (int, optional): y lags x by this many time steps, negative values lead. Defaults to 0.
+            siglevel (float, optional): If given, corr and slope are set to NaN where pvalue>=siglevel. Defaults to None.
+            max_memory (int, optional): Approximate memory per block in MB. Defaults to 256.
 
-        ds=self.ds
-        if dim==3:
-            var=ds[f"{var}"][:,0,:,:].values
-        
+        Returns:
+            xarray Dataset: corr, slope, intercept, pvalue and n at every grid point.
+        """
+        x=self.ds[f"{var}"]
         if dim==4:
-            var=ds[f"{var}"][:,lv,:,:].values
-        nt,nlat,nlon=var.shape
-
-        if nt%365==0:
-            time=pd.DataFrame(ds.time,columns=["Date"])
-
-            TimeSeries=var.reshape((nt,nlat*nlon), order='F')
-
-            df=pd.DataFrame(TimeSeries,index=time["Date"])
-            ts=df.values
-            var_anomaly= np.zeros(ts.shape) # calculate the anomaly
-
-            time_cycle=365
-            for i in range(time_cycle):
-                sample = ts[i::time_cycle, :]
-                var_anomaly[i::time_cycle, :] = sample - sample.mean(axis=0)
-
-            data=var_anomaly.reshape((ts.shape[0],nlat,nlon), order='F')
-            ds_new= xr.Dataset({
-                'variable': xr.DataArray(
-                            data   = data,   # enter data here
-                            dims   = ['time','lat','lon'],
-                            coords = {'time': df.index.values,'lat':ds.lat,'lon':ds.lon},
-                            attrs  = {
-                                '_FillValue': -999.9,
-                                'units'     : 'K'
-                                }
-                            ),})
-            
-            
-            ds_new.rename(name_dict={"variable":f'{var}'})
+            x=x[:,level]
+
+        if isinstance(other,netcdf):
+            other=other.ds
+        if isinstance(other,xr.Dataset):
+            y=other[f"{othervar if othervar!=None else var}"]
+            if dim==4:
+                y=y[:,level]
         else:
-            print('We use 365 days as a year to compute the anomaly')
+            y=other
 
-        return ds_new
+        if len(x.time)!=len(y.time):
+            raise ValueError("The two series have {} and {} time steps".format(len(x.time),len(y.time)))
+        nt=len(x.time)
+        if lag>=0:
+            x,y=x.isel(time=slice(0,nt-lag)),y.isel(time=slice(lag,nt))
+        else:
+            x,y=x.isel(time=slice(-lag,nt)),y.isel(time=slice(0,nt+lag))
+        y=y.assign_coords(time=x.time.values)
+
+        rows=1
+        if "lat" in x.dims:
+            row_bytes=8*len(x.time)*int(np.prod([x.sizes[d] for d in x.dims if d not in ("time","lat")]))
+            rows=max(1,int(max_memory*2**20/(4*row_bytes)))
+
+        blocks=[]
+        for start in range(0,x.sizes.get("lat",1),rows):
+            if "lat" in x.dims:
+                xb=x.isel(lat=slice(start,start+rows))
+                yb=y.isel(lat=slice(start,start+rows)) if "lat" in y.dims else y
+            else:
+                xb,yb=x,y
+            xb,yb=xr.broadcast(xb,yb)
+            xb=xb.transpose("time",...)
+            yb=yb.transpose(*xb.dims)
+            coords={k:v for k,v in xb.coords.items() if "time" not in v.dims}
+            spatial=xb.dims[1:]
+            with self._scheduler():
+                xb,yb=xb.values,yb.values
+            stats=_pearson(xb.astype(float),yb.astype(float))
+            blocks.append(xr.Dataset({name:(spatial,value) for name,value in
+                                      zip(["corr","slope","intercept","pvalue","n"],stats)},coords=coords))
+
+        out=xr.concat(blocks,dim="lat") if len(blocks)>1 else blocks[0]
+        if siglevel!=None:
+            out["corr"]=out["corr"].where(out["pvalue"]<siglevel)
+            out["slope"]=out["slope"].where(out["pvalue"]<siglevel)
+        return out
+
+    @profiled("compute")
+    @cached(persist=True)
     def _annual_mean(self):
         """ Compute the annual mean """
         return self.ds.groupby('time.year').mean('time')
 
-    def _plot_annual_mean(self,var,level=0,dim=3,convert="",clim=None,
-                          clevels=None,cmap='jet',savefig=False,savefigpath="./",
-                          savefigname="fig",svformat=".png",dpi=300):
-        
-        ds1=self._annual_mean()
-        db=ds1.mean('year')
+    @profiled("render")
+    def _plot_annual_mean(self,*args,**kwargs):
+        " We plot the mean of the annual means, see netcdf_plotting._plot_annual_mean"
+        return _plotting()._plot_annual_mean(self,*args,**kwargs)
 
-        if dim==3:
-            da=db[f'{var}']
+    @profiled("render")
+    def _mean_annual_difference(self,*args,**kwargs):
+        " We plot the difference of the mean annual fields of two datasets, see netcdf_plotting._mean_annual_difference"
+        return _plotting()._mean_annual_difference(self,*args,**kwargs)
 
-        if dim==4:
-            da=db[f'{var}'][level,:,:]
-        
-        if convert=="m2mm":
-            print("The unit is converted from m to mm")
-            da=da*1000
-
-        if clevels==None:
-            levels=20
-        plt.figure(figsize=(7.5,4.5),constrained_layout=True)
-        ax = plt.axes(projection=ccrs.PlateCarree())
-        ax.coastlines(resolution='110m') 
-        #ax.add_feature(cfeature.LAND,zorder=2)
-        
-        plot_kwargs={"orientation": "horizontal","fraction":0.12,
-                     'pad':0.03,'aspect':40}
-        if clim==None:
-            da.plot(levels=30,\
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-        if clim !=None:
-            da.plot(levels=30,vmin=clim[0],vmax=clim[1],
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-
-        if savefig==True:
-            plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
-
-        plt.show()
-
-    def _mean_annual_difference(self,ds1,var1,var2='',samedata=True,dim=3,level=0,
-                                title="Mean annual difference",
-                                savefig=False,savefigpath="./",savefigname="fig",
-                                    svformat=".png",cmap="RdBu_r",dpi=300):
-        
-        ds=self._annual_mean()
+    @profiled("compute")
+    def _spatial_mean(self,var,dims,lat=None,lon=None,level=None,time=None,timemean=False):
+        """Area-weighted mean of a variable over dims, in a region selected lazily.
 
-        damon=ds.mean("year")
-        dbmon=ds1.mean("year")
-        if samedata==True:
-            var2=var1
-        
-        if dim==4:
-            diff=damon[f'{var1}'][level,:,:]-dbmon[f'{var2}'][level,:,:]
-
-        else:
-            diff=damon[f'{var1}']-dbmon[f'{var2}']
-        plt.figure(figsize=(7.5,4.5),constrained_layout=True)
-        ax = plt.axes(projection=ccrs.PlateCarree())
-        ax.coastlines(resolution='110m') 
-        #ax.add_feature(cfeature.LAND,zorder=2)
-
-        plot_kwargs={"orientation": "horizontal","fraction":0.12,
-                        'pad':0.03,'aspect':40}
+        Args:
+            var (str): variable name
+            dims (list): dimensions to average over, e.g. ["lat","lon"].
+            lat (tuple, optional): (south, north). Defaults to None (all).
+            lon (tuple, optional): (west, east). Defaults to None (all).
+            level (int, optional): Index of the pressure level. Defaults to None (all levels).
+            time (tuple, optional): (start, end) dates. Defaults to None (all).
+            timemean (bool, optional): Average over time as well. Defaults to False.
+
+        Returns:
+            xarray DataArray: the (lazy) mean.
+        """
+        da=_select(self.ds[f"{var}"],lat,lon,level,time)
+        dims=list(dims)+(["time"] if timemean==True else [])
+        return _area_mean(da,dims)
 
-        diff.plot(levels=30,\
-                cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
-        plt.title(title,fontsize=14)
-        if savefig==True:
-            plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+    def _zonal_average(self,var,**region):
+        " Zonal mean (over longitude) as a function of latitude, see _spatial_mean for the arguments"
+        return self._spatial_mean(var,["lon"],**region)
 
-        plt.show()
+    def _meridional_average(self,var,**region):
+        " cos(lat) weighted mean over latitude as a function of longitude, see _spatial_mean"
+        return self._spatial_mean(var,["lat"],**region)
 
-    def _zonal_mean(self,var,lat,level=0,dim=3,savefig=False,savefigpath="./",savefigname="fig",svformat=".png",dpi=300):
-        " This function computes the zonal mean"
+    def _box_mean(self,var,lat,lon,**region):
+        """Area-weighted box mean time series.
 
-        if dim==3:
-            da=self.ds[f"{var}"][:,:,:].values
-        if dim==4:
-            da=self.ds[f"{var}"][:,level,:,:].values
+        Args:
+            var (str): variable name
+            lat (tuple): (south, north)
+            lon (tuple): (west, east)
+        """
+        return self._spatial_mean(var,["lat","lon"],lat=lat,lon=lon,**region)
 
-        mean_time=da.mean(axis=0)
-        lon_mean=mean_time.mean(axis=1)
+    def _global_mean(self,var,**region):
+        " Area-weighted global mean time series, see _spatial_mean"
+        return self._spatial_mean(var,["lat","lon"],**region)
 
-        plt.figure(figsize=(5.5,3.5),constrained_layout=True)
-        plt.plot(lat,lon_mean)
-        plt.grid(linewidth=0.35)
-        plt.title("Zonal mean of {}".format(var),fontsize=12)
-        if savefig==True:
-            plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+    @profiled("render")
+    def _zonal_mean(self,*args,**kwargs):
+        " We plot the zonal mean, see netcdf_plotting._zonal_mean"
+        return _plotting()._zonal_mean(self,*args,**kwargs)
 
-        plt.show()
+    @profiled("render")
+    def _vertical_profile(self,*args,**kwargs):
+        " We plot the vertical profile averaged over a latitude band, see netcdf_plotting._vertical_profile"
+        return _plotting()._vertical_profile(self,*args,**kwargs)
 
-    def _vertical_profile(self,var,latitude,longitude,plevel,latrange=[15,-15],exdata=None,savefig=False,savefigpath="./",savefigname="fig",svformat=".png",cmap="jet",dpi=300,title=None):
+    def _vertical_profile_from_data(*args,**kwargs):
+        " We plot the vertical profile of a dataset averaged over a latitude band, see netcdf_plotting._vertical_profile_from_data"
+        return _plotting()._vertical_profile_from_data(*args,**kwargs)
 
-        
-        d=self._annual_mean()
-
-        _range=np.where((latitude<=latrange[0])&(latitude>=latrange[1]))[0]
-        var_=d[f"{var}"]
-        var_z=var_[:,:,_range[0]:_range[-1]+1,:]
-
-        zonal_mean_time=var_z.mean(axis=0)
-
-        zonal_mean=zonal_mean_time.mean(axis=1)
-     
-        plt.figure(figsize=(9.5,4.5))
-        plt.contourf(longitude,plevel,zonal_mean,20,cmap=cmap)
-        plt.gca().invert_yaxis()
-        #plt.colorbar(label="CC")
-        plt.colorbar()
-        plt.xlabel(r"Longitude ($^{o}E$)",fontsize=14)
-        plt.ylabel("Pressure levels (hPa)",fontsize=14)
-        plt.tick_params(labelsize=12)
-        if title ==None:
-            plt.title(r"Vertcal profile of {} in lat range {}".format(var,latrange),fontsize=14)
-        else:
-            plt.title(f"{title}",fontsize=14)
-        if savefig==True:
-            plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
-
-        plt.show()
-
-    def _vertical_profile_from_data(data,var,latitude,longitude,plevel,latrange=[15,-15],
-                                    savefig=False,savefigpath="./",savefigname="fig",
-                                    svformat=".png",cmap="jet",dpi=300):
-
-        d=data
-        _range=np.where((latitude<=latrange[0])&(latitude>=latrange[1]))[0]
-        var_=d[f"{var}"]
-        var_z=var_[:,:,_range[0]:_range[-1]+1,:]
-
-        zonal_mean_time=var_z.mean(axis=0)
-
-        zonal_mean=zonal_mean_time.mean(axis=1)
-     
-        plt.figure(figsize=(9.5,4.5))
-        plt.contourf(longitude,plevel,zonal_mean,20,cmap=cmap)
-        plt.gca().invert_yaxis()
-        #plt.colorbar(label="CC")
-        plt.colorbar()
-        plt.xlabel(r"Longitude ($^{o}E$)",fontsize=14)
-        plt.ylabel("Pressure levels (hPa)",fontsize=14)
-        plt.tick_params(labelsize=12)
-        plt.title(r"Vertcal profile of {} in lat range {}".format(var,latrange),fontsize=14)
-        if savefig==True:
-            plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
-
-        plt.show()
-    
     #def _daily_anomaly(ds,var,level=0,dim=3):
         
 
@@ -0,0 +1,337 @@
+"""
+This file contains the plotting layer of the netcdf class.
+
+It is imported by netcdf_analysis the first time a plot method is called, so
+that matplotlib and cartopy are not loaded by analysis-only jobs.
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.patches as patches
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+
+from netcdf_analysis import _select, _area_mean
+
+
+def _at_time(da,timestamp):
+    " The field at a position, or at the date nearest to a label such as '2001-07-15'"
+    if isinstance(timestamp,(int,np.integer)):
+        return da[timestamp]
+    return da.sel(time=timestamp,method="nearest")
+
+
+def _plotdata(data,lat,lon,central_longitude=180,figsize=(7.5,5.5),size=14,
+              fontfamily="sans-serif",extent=None,cmap="jet",cextend="both",
+              clim=None,clevel=20,title=None,cbar_label=None,cbar_position="vertical",
+              savefig=False,savefigpath=None,savefigname="fig",
+              svformat=".png",dpi=300,nan=False,land=True):
+    """This function plots the netcdf file
+
+    Args:
+        figsize (tuple, optional): _description_. Defaults to (7.5,5.5).
+        title (str, optional): set the title of the plot . Defaults to None.
+        cbar_label (str, optional): set the label of the colorbar. Defaults to None.
+        savefig (bool, optional): to save the figure. Defaults to False.
+        savefigpath (str, optional): destination of the plot to save. Defaults to None.
+        extent (list, optional): [lon0,lon1,lat0,lat1] of the map. When data is a DataArray
+            only this region is read. Defaults to the data extent.
+        format(str,optional): The format of the plot to be saved. Defaults to .png
+    """
+
+    if extent!=None and hasattr(data,"sel"):
+        # only the region shown is read and contoured
+        data=_select(data,lat=extent[2:],lon=extent[:2])
+        lat,lon=data.lat.values,data.lon.values
+    data=np.asarray(data)
+    latitude=lat
+    longitude=lon
+    ticksize=size
+    fontsize=size+2
+    #data=nc.ds.values
+    #if fontfamily==None:
+    #    plt.rcParams["font.family"]="sans-serif"
+    #else:
+    plt.rcParams["font.family"]=fontfamily
+    plt.rcParams["font.size"]=size
+    if clim==None:
+        lv=np.linspace(np.percentile(data,25),np.percentile(data,75),15)
+    else:
+        lv=np.linspace(clim[0],clim[1],clevel)
+
+    fig, ax = plt.subplots(subplot_kw={'projection': ccrs.PlateCarree(central_longitude)},figsize=figsize)
+
+    if extent ==None:
+        ax.set_extent([min(longitude),max(longitude),min(latitude),max(latitude)],crs=ccrs.PlateCarree())
+    if extent!=None:
+        ax.set_extent(extent,crs=ccrs.PlateCarree())
+
+    mm = ax.contourf(longitude,latitude,data,transform=ccrs.PlateCarree(),\
+             levels=lv,\
+             cmap=cmap,extend=cextend)
+    if nan==True:
+        if len(np.isnan(data))>=0:
+            xmin, xmax = ax.get_xlim()
+            ymin, ymax = ax.get_ylim()
+            xy = (xmin,ymin)
+            width = xmax - xmin
+            height = ymax - ymin
+            p = patches.Rectangle(xy, width, height, hatch='/', fill=None, zorder=-2)
+            ax.add_patch(p)
+    ax.coastlines(resolution='110m')
+    #ax.add_feature(cfeature.OCEAN.with_scale('110m'),zorder=2)
+    ax.add_feature(cfeature.BORDERS.with_scale('50m'))
+    ax.add_feature(cfeature.STATES)
+    if land==True:
+        ax.add_feature(cfeature.LAND,zorder=2)
+    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                    linewidth=1, color='gray', alpha=0.5, linestyle='--')
+    #gl.xlabels_top = False
+    gl.top_labels = False
+    gl.right_labels = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+
+    im_ratio = data.shape[0]/data.shape[1]
+    cb = plt.colorbar(mm, shrink=0.9,orientation=cbar_position, drawedges='True',pad=0.03,fraction=0.04*im_ratio,ticks=lv[::2],format="%3.1f")
+    cb.ax.tick_params(size=10,labelsize=ticksize-2)
+    if cbar_label!=None:
+        cb.set_label(label=cbar_label,size=size-2)
+
+    if title!=None:
+        ax.set_title(title,fontsize=size)
+
+    if savefig==True:
+
+        #print("As the savefigname is not given, so it saves as fig")
+        #plt.savefig(savefigpath+savefigname+svformat,dpi=dpi,bbox_inches="tight")
+        plt.savefig(savefigpath+savefigname+svformat,dpi=dpi,bbox_inches="tight")
+    plt.show()
+
+# We plot the data using xarray inbuilt function
+def _plot_with_xarray(nc,var,level=0,dim=3,timestamp=0,clim=None,clevels=None,cmap='jet'):
+    """By calling this method, one can plot the file for a particular date, pressure level
+
+    Args:
+        var (str): variable name
+        level (int, optional): Pressure level. Defaults to 0.
+        dim (int, optional): If the dataset has multiple levels then change dim=4. Defaults to 3.
+        timestamp (int or str, optional): The time we want to visulize, a position or a date. Defaults to 0.
+        clim (_type_, optional): colorbar limit, should be a list/array, e.g., [low,high]. Defaults to None.
+        clevels (_type_, optional): No of levels in the colorbar. Defaults to None.
+        cmap (str, optional): colormap. Defaults to 'jet'.
+    """
+
+    da=_at_time(nc.ds[f"{var}"],timestamp)
+    if dim==4:
+        da=da[level,:,:]
+    if clevels==None:
+        levels=20
+    da=nc._compute(da)
+    plt.figure(figsize=(7.5,4.5),constrained_layout=True)
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.coastlines(resolution='110m') 
+    #ax.add_feature(cfeature.LAND,zorder=2)
+
+    plot_kwargs={"orientation": "horizontal","fraction":0.12,
+                 'pad':0.03,'aspect':40}
+    if clim==None:
+        da.plot(levels=30,\
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    if clim !=None:
+        da.plot(levels=30,vmin=clim[0],vmax=clim[1],
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+
+    plt.show()
+
+def _plot_monthly_climatology(nc,var,level=0,dim=3,mon=0,clim=None,levels=None,cmap='jet'):
+    " We plot the monthly climatology"
+    dm=nc._mon_climatology()
+    if dim==3:
+        da=dm[f"{var}"][mon-1,:,:]
+    if dim==4:
+        da=dm[f"{var}"][mon-1,level,:,:]
+
+    if levels==None:
+        levels=20
+    months=["Jan","Feb","March","April","May","June","July","Aug","Sep","Oct","Nov","Dec"]
+    da=nc._compute(da)
+    plt.figure(figsize=(7.5,4.5),constrained_layout=True)
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.coastlines(resolution='110m') 
+    ax.add_feature(cfeature.LAND,zorder=2)
+
+    plot_kwargs={"orientation": "horizontal","fraction":0.12,
+                 'pad':0.03,'aspect':40}
+    if clim==None:
+        da.plot(levels=30,\
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    if clim !=None:
+        da.plot(levels=30,vmin=clim[0],vmax=clim[1],
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+
+    ax.set_title("Monthly climatology of {} for month {}".format(var,months[mon-1]),fontsize=16)
+    plt.show()
+
+def _plot_monthly_anomaly(nc,var,level=0,dim=3,timestamp=0,clim=None,levels=None,cmap='jet'):
+
+    dm=nc._monthly_anomaly()
+    da=_at_time(dm[f"{var}"],timestamp)
+    if dim==4:
+        da=da[level,:,:]
+
+    if levels==None:
+        levels=20
+    da=nc._compute(da)
+    plt.figure(figsize=(7.5,4.5),constrained_layout=True)
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.coastlines(resolution='110m') 
+    ax.add_feature(cfeature.LAND,zorder=2)
+
+    plot_kwargs={"orientation": "horizontal","fraction":0.12,
+                 'pad':0.03,'aspect':40}
+    if clim==None:
+        da.plot(levels=30,\
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    if clim !=None:
+        da.plot(levels=30,vmin=clim[0],vmax=clim[1],
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+
+    ax.set_title("Monthly anomaly of {}".format(var),fontsize=14)
+    plt.show()
+
+def _plot_annual_mean(nc,var,level=0,dim=3,convert="",clim=None,
+                      clevels=None,cmap='jet',savefig=False,savefigpath="./",
+                      savefigname="fig",svformat=".png",dpi=300):
+
+    ds1=nc._annual_mean()
+    db=ds1.mean('year')
+
+    if dim==3:
+        da=db[f'{var}']
+
+    if dim==4:
+        da=db[f'{var}'][level,:,:]
+
+    if convert=="m2mm":
+        print("The unit is converted from m to mm")
+        da=da*1000
+
+    if clevels==None:
+        levels=20
+    da=nc._compute(da)
+    plt.figure(figsize=(7.5,4.5),constrained_layout=True)
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.coastlines(resolution='110m') 
+    #ax.add_feature(cfeature.LAND,zorder=2)
+
+    plot_kwargs={"orientation": "horizontal","fraction":0.12,
+                 'pad':0.03,'aspect':40}
+    if clim==None:
+        da.plot(levels=30,\
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    if clim !=None:
+        da.plot(levels=30,vmin=clim[0],vmax=clim[1],
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+
+    if savefig==True:
+        plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+
+    plt.show()
+
+def _mean_annual_difference(nc,ds1,var1,var2='',samedata=True,dim=3,level=0,
+                            title="Mean annual difference",
+                            savefig=False,savefigpath="./",savefigname="fig",
+                                svformat=".png",cmap="RdBu_r",dpi=300):
+
+    ds=nc._annual_mean()
+
+    damon=ds.mean("year")
+    dbmon=ds1.mean("year")
+    if samedata==True:
+        var2=var1
+
+    if dim==4:
+        diff=damon[f'{var1}'][level,:,:]-dbmon[f'{var2}'][level,:,:]
+
+    else:
+        diff=damon[f'{var1}']-dbmon[f'{var2}']
+    diff=nc._compute(diff)
+    plt.figure(figsize=(7.5,4.5),constrained_layout=True)
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.coastlines(resolution='110m') 
+    #ax.add_feature(cfeature.LAND,zorder=2)
+
+    plot_kwargs={"orientation": "horizontal","fraction":0.12,
+                    'pad':0.03,'aspect':40}
+
+    diff.plot(levels=30,\
+            cbar_kwargs=plot_kwargs,robust=True,cmap=cmap)
+    plt.title(title,fontsize=14)
+    if savefig==True:
+        plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+
+    plt.show()
+
+def _zonal_mean(nc,var,lat,level=0,dim=3,savefig=False,savefigpath="./",savefigname="fig",svformat=".png",dpi=300):
+    " This function computes the zonal mean"
+
+    lon_mean=nc._compute(nc._zonal_average(var,level=level if dim==4 else None,timemean=True))
+
+    plt.figure(figsize=(5.5,3.5),constrained_layout=True)
+    plt.plot(lat,lon_mean)
+    plt.grid(linewidth=0.35)
+    plt.title("Zonal mean of {}".format(var),fontsize=12)
+    if savefig==True:
+        plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+
+    plt.show()
+
+def _vertical_profile(nc,var,latitude,longitude,plevel,latrange=[15,-15],exdata=None,savefig=False,savefigpath="./",savefigname="fig",svformat=".png",cmap="jet",dpi=300,title=None):
+
+
+    d=nc._annual_mean()
+
+    var_z=_select(d[f"{var}"],lat=latrange)
+    zonal_mean=nc._compute(_area_mean(var_z,["year","lat"]))
+
+    plt.figure(figsize=(9.5,4.5))
+    plt.contourf(longitude,plevel,zonal_mean,20,cmap=cmap)
+    plt.gca().invert_yaxis()
+    #plt.colorbar(label="CC")
+    plt.colorbar()
+    plt.xlabel(r"Longitude ($^{o}E$)",fontsize=14)
+    plt.ylabel("Pressure levels (hPa)",fontsize=14)
+    plt.tick_params(labelsize=12)
+    if title ==None:
+        plt.title(r"Vertcal profile of {} in lat range {}".format(var,latrange),fontsize=14)
+    else:
+        plt.title(f"{title}",fontsize=14)
+    if savefig==True:
+        plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+
+    plt.show()
+
+def _vertical_profile_from_data(data,var,latitude,longitude,plevel,latrange=[15,-15],
+                                savefig=False,savefigpath="./",savefigname="fig",
+                                svformat=".png",cmap="jet",dpi=300):
+
+    d=data
+    var_z=_select(d[f"{var}"],lat=latrange)
+    zonal_mean=_area_mean(var_z,[var_z.dims[0],"lat"]).values
+
+    plt.figure(figsize=(9.5,4.5))
+    plt.contourf(longitude,plevel,zonal_mean,20,cmap=cmap)
+    plt.gca().invert_yaxis()
+    #plt.colorbar(label="CC")
+    plt.colorbar()
+    plt.xlabel(r"Longitude ($^{o}E$)",fontsize=14)
+    plt.ylabel("Pressure levels (hPa)",fontsize=14)
+    plt.tick_params(labelsize=12)
+    plt.title(r"Vertcal profile of {} in lat range {}".format(var,latrange),fontsize=14)
+    if savefig==True:
+        plt.savefig(savefigpath+savefigname+svformat,bbox_inches="tight",dpi=dpi)
+
+    plt.show()
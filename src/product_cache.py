@@ -0,0 +1,224 @@
+"""
+This file contains the cache of the derived products (climatologies, anomalies, ...)
+computed by the netcdf class.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+
+from instrumentation import recording
+
+
+def _nbytes(value):
+    " Size of a cached product in bytes"
+    return getattr(value,"nbytes",0)
+
+
+class ProductCache:
+    def __init__(self,max_memory=1024):
+        """A least recently used cache with a memory cap.
+
+        Args:
+            max_memory (float, optional): Memory cap in MB, 0 disables the cache. Defaults to 1024.
+        """
+        self.max_bytes=max_memory*2**20
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self._store=OrderedDict()
+        self._lock=threading.Lock()
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self,key):
+        return key in self._store
+
+    def get(self,key):
+        " Return the cached product, or None"
+        with self._lock:
+            if key not in self._store:
+                self.misses+=1
+                return None
+            self.hits+=1
+            self._store.move_to_end(key)
+            return self._store[key]
+
+    def put(self,key,value):
+        " Add a product, evicting the least recently used ones above the memory cap"
+        size=_nbytes(value)
+        with self._lock:
+            if key in self._store:
+                self.nbytes-=_nbytes(self._store.pop(key))
+            if size>self.max_bytes:
+                return
+            self._store[key]=value
+            self.nbytes+=size
+            while self.nbytes>self.max_bytes:
+                _,old=self._store.popitem(last=False)
+                self.nbytes-=_nbytes(old)
+
+    def invalidate(self,product=None,var=None):
+        """Remove cached products.
+
+        Args:
+            product (str, optional): Only remove this product, e.g. "_mon_climatology". Defaults to None (all).
+            var (str, optional): Only remove the products of this variable. Defaults to None (all).
+        """
+        with self._lock:
+            for key in list(self._store):
+                if product!=None and key[0]!=product:
+                    continue
+                if var!=None and dict(key[1]).get("var")!=var:
+                    continue
+                self.nbytes-=_nbytes(self._store.pop(key))
+
+
+class ProductStore:
+    def __init__(self,path,format="netcdf"):
+        """A directory of derived products saved on disk, one file per fingerprint.
+
+        Args:
+            path (str): The directory of the store, created if needed.
+            format (str, optional): "netcdf" or "zarr" (needs the zarr package). Defaults to "netcdf".
+        """
+        if format not in ("netcdf","zarr"):
+            raise ValueError("format should be 'netcdf' or 'zarr', not {}".format(format))
+        self.path=path
+        self.format=format
+        os.makedirs(path,exist_ok=True)
+
+    def _filename(self,fingerprint):
+        return os.path.join(self.path,fingerprint+(".nc" if self.format=="netcdf" else ".zarr"))
+
+    def get(self,fingerprint):
+        " Load a stored product, or None"
+        filename=self._filename(fingerprint)
+        if not os.path.exists(filename):
+            return None
+        if self.format=="netcdf":
+            with xr.open_dataset(filename) as ds:
+                ds=ds.load()
+        else:
+            ds=xr.open_zarr(filename).load()
+        if "__dataarray__" in ds.attrs:
+            name=ds.attrs["__dataarray__"]
+            da=ds[name]
+            return da.rename(None) if name=="__values__" else da
+        return ds
+
+    def put(self,fingerprint,value):
+        " Save a product atomically, chunked and compressed"
+        if isinstance(value,xr.DataArray):
+            name=value.name if value.name!=None else "__values__"
+            value=value.to_dataset(name=name)
+            value.attrs["__dataarray__"]=name
+        chunks={v:tuple(min(n,256) for n in value[v].shape) for v in value.data_vars if value[v].ndim>0}
+
+        filename=self._filename(fingerprint)
+        tmp=filename+".tmp{}".format(os.getpid())
+        if self.format=="netcdf":
+            encoding={v:{"zlib":True,"complevel":4,"shuffle":True,"chunksizes":c} for v,c in chunks.items()}
+            value.to_netcdf(tmp,encoding=encoding)
+            os.replace(tmp,filename)
+        else:
+            value.to_zarr(tmp,mode="w",encoding={v:{"chunks":c} for v,c in chunks.items()})
+            if os.path.exists(filename):
+                shutil.rmtree(filename)
+            os.replace(tmp,filename)
+
+    def clear(self):
+        " Remove every stored product"
+        for f in os.listdir(self.path):
+            full=os.path.join(self.path,f)
+            if os.path.isdir(full):
+                shutil.rmtree(full)
+            else:
+                os.remove(full)
+
+
+def fingerprint(name,arguments,ds,files,time_range):
+    """Fingerprint of a derived product.
+
+    It depends on the product and its arguments, the variables and their dtypes,
+    the sizes, time range and coordinate bounds of the dataset (so that two subsets of the same
+    files differ), and the path, size and modification time of every
+    source file, so that it changes when any of them does.
+    """
+    sha=hashlib.sha256()
+    bounds=sorted((d,str(ds[d].values[[0,-1]])) for d in ds.dims if d in ds.coords and ds.sizes[d]>0)
+    dtypes=sorted((v,str(ds[v].dtype)) for v in ds.data_vars)
+    sha.update(repr((name,arguments,time_range,dtypes,sorted(ds.sizes.items()),bounds)).encode())
+    for f in sorted(files):
+        stat=os.stat(f)
+        sha.update(repr((os.path.abspath(f),stat.st_size,stat.st_mtime)).encode())
+    return sha.hexdigest()
+
+
+def _persist(nc,value):
+    " Compute a lazy product that fits in the cache, on the scheduler of nc, keeping it dask backed"
+    if getattr(nc,"execution",None)==None or not hasattr(value,"persist") or _nbytes(value)>nc.cache.max_bytes:
+        return value
+    with nc._scheduler():
+        return value.persist()
+
+
+def cached(method=None,persist=False):
+    """Memoize a netcdf method in ``self.cache``.
+
+    The key is the method name, its arguments (with the defaults filled in, so
+    that ``f("air")`` and ``f("air",0)`` share an entry), the time range of
+    the dataset and its version, which changes whenever ``self.ds`` is
+    assigned. The cached object is returned as is, so it should not be
+    modified in place.
+
+    With ``persist=True`` the product is also saved in ``self.store``, if the
+    netcdf object has one and knows its source files, and reused by later
+    sessions as long as the fingerprint matches. The fingerprint only sees the
+    files, so a dataset modified in memory (``self._modified``) skips the store.
+
+    In lazy mode (see netcdf._set_execution) the products that fit in the cache
+    are persisted when they are computed, so later plots and saves reuse the
+    values instead of reducing the dataset again.
+    """
+    if method is None:
+        return functools.partial(cached,persist=persist)
+    signature=inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        bound=signature.bind(self,*args,**kwargs)
+        bound.apply_defaults()
+        arguments=tuple((k,v) for k,v in bound.arguments.items() if k!="self")
+        try:
+            key=(method.__name__,arguments,self._time_range(),self._version)
+            hash(key)
+        except TypeError:
+            return method(self,*args,**kwargs)
+
+        value=self.cache.get(key)
+        if value is not None:
+            return value
+
+        files=self._source_files() if persist and self.store!=None and not self._modified else []
+        if files:
+            fp=fingerprint(method.__name__,arguments,self.ds,files,self._time_range())
+            profiler=getattr(self,"profiler",None)
+            with recording(profiler,"store_get","load"):
+                value=self.store.get(fp)
+            if value is None:
+                value=_persist(self,method(self,*args,**kwargs))
+                with recording(profiler,"store_put","save"):
+                    self.store.put(fp,value)
+        else:
+            value=_persist(self,method(self,*args,**kwargs))
+        self.cache.put(key,value)
+        return value
+    return wrapper
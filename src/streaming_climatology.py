@@ -0,0 +1,308 @@
+"""
+This file contains a streaming climatology and anomaly pipeline for the yearly
+files written by get_data.
+
+The files are read one year at a time, so the peak memory is about one year
+of data whatever the length of the record. The climatologies are kept as
+mergeable accumulators, so that a new year, or a new base period, only needs
+the affected years to be read.
+"""
+
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+from netcdf_analysis import _dayofyear, _make_time, _yearly_files
+
+
+def _data_vars(ds):
+    " The numerical variables with a time dimension"
+    return [v for v in ds.data_vars if "time" in ds[v].dims and np.issubdtype(ds[v].dtype,np.number)]
+
+
+class ClimatologyAccumulator:
+    def __init__(self,group="month",leap="feb28"):
+        """Running count, sum and sum of squares per month or day-of-year and grid point.
+
+        The years that went in are recorded with their annual means and the size and
+        modification time of their files, and a year can be removed again, so the
+        base period can be moved by only touching the years that change.
+
+        Args:
+            group (str, optional): "month" or "dayofyear". Defaults to "month".
+            leap (str, optional): Leap day handling of the day-of-year groups, see
+                netcdf._daily_climatology. Defaults to "feb28".
+        """
+        if group not in ("month","dayofyear"):
+            raise ValueError("group should be 'month' or 'dayofyear', not {}".format(group))
+        self.group=group
+        self.leap=leap
+        self.count=None
+        self.sum=None
+        self.sumsq=None
+        self.annual=None
+        self.years=[]
+        self.sources={}
+
+    def _key(self,time):
+        if self.group=="month":
+            return time.dt.month.rename("month")
+        return _dayofyear(time,self.leap)
+
+    def _merge(self,count,total,sumsq,sign=1):
+        if self.count is None:
+            self.count,self.sum,self.sumsq=count,total,sumsq
+            return
+        fields=xr.align(self.count,self.sum,self.sumsq,count,total,sumsq,join="outer",fill_value=0)
+        self.count=fields[0]+sign*fields[3]
+        self.sum=fields[1]+sign*fields[4]
+        self.sumsq=fields[2]+sign*fields[5]
+
+    def _sums(self,ds):
+        ds=ds[_data_vars(ds)]
+        key=self._key(ds.time)
+        filled=ds.fillna(0).astype("float64")
+        return (ds.notnull().groupby(key).sum("time").astype("int64"),
+                filled.groupby(key).sum("time"),
+                (filled**2).groupby(key).sum("time"))
+
+    def add(self,ds,source=None):
+        """Accumulate a dataset, typically one year. NaNs are not counted.
+
+        Args:
+            ds (xarray Dataset): The data, with a time dimension.
+            source (list, optional): [size, mtime] of the file of ds, see _stamp. Defaults to None.
+        """
+        years=[int(y) for y in np.unique(ds.time.dt.year)]
+        if set(years)&set(self.years):
+            raise ValueError("The years {} are already in the climatology".format(sorted(set(years)&set(self.years))))
+        self._merge(*self._sums(ds))
+        annual=ds[_data_vars(ds)].groupby("time.year").mean("time")
+        self.annual=annual if self.annual is None else xr.concat([self.annual,annual],dim="year").sortby("year")
+        self.years=sorted(self.years+years)
+        if source!=None:
+            self.sources.update({y:list(source) for y in years})
+        return self
+
+    def remove(self,ds):
+        """Take a dataset that was added before out of the climatology.
+
+        Args:
+            ds (xarray Dataset): The same data that was added, e.g. one year.
+        """
+        years=[int(y) for y in np.unique(ds.time.dt.year)]
+        if not set(years)<=set(self.years):
+            raise ValueError("The years {} are not in the climatology".format(sorted(set(years)-set(self.years))))
+        self._merge(*self._sums(ds),sign=-1)
+        self.annual=self.annual.drop_sel(year=years)
+        self.years=[y for y in self.years if y not in years]
+        for y in years:
+            self.sources.pop(y,None)
+        return self
+
+    def __add__(self,other):
+        " Merge two accumulators of different years"
+        if (self.group,self.leap)!=(other.group,other.leap):
+            raise ValueError("Only accumulators of the same group can be merged")
+        if set(self.years)&set(other.years):
+            raise ValueError("The years {} are in both climatologies".format(sorted(set(self.years)&set(other.years))))
+        out=ClimatologyAccumulator(self.group,self.leap)
+        for acc in (self,other):
+            if acc.count is not None:
+                out._merge(acc.count,acc.sum,acc.sumsq)
+                out.annual=acc.annual if out.annual is None else xr.concat([out.annual,acc.annual],dim="year").sortby("year")
+        out.years=sorted(self.years+other.years)
+        out.sources={**self.sources,**other.sources}
+        return out
+
+    def mean(self):
+        " The climatology, NaN where there is no data"
+        return (self.sum/self.count).where(self.count>0)
+
+    def variance(self,ddof=1):
+        " The variance around the climatology"
+        var=(self.sumsq-self.sum**2/self.count)/(self.count-ddof)
+        return var.clip(min=0).where(self.count>ddof)
+
+    def std(self,ddof=1):
+        " The standard deviation around the climatology"
+        return np.sqrt(self.variance(ddof))
+
+    def seasonal_mean(self,months):
+        """Climatological mean over some months, e.g. [6,7,8,9], the mean of their monthly
+        means like netcdf._mean_seasonal_climatology.
+
+        Only for group="month".
+        """
+        if self.group!="month":
+            raise ValueError("seasonal_mean needs a monthly accumulator")
+        clim=self.mean()
+        return clim.sel(month=[m for m in months if m in clim.month.values]).mean("month")
+
+    def total_mean(self):
+        " Mean over all the time steps of all the years"
+        return self.sum.sum(self.group)/self.count.sum(self.group)
+
+    def annual_mean(self):
+        " The annual mean of every year, like netcdf._annual_mean"
+        return self.annual
+
+    def to_netcdf(self,filename):
+        " Save the accumulator atomically"
+        if self.count is None:
+            raise ValueError("The climatology is empty")
+        out=xr.Dataset(attrs={"group":self.group,"leap":self.leap,"years":np.array(self.years,dtype="int32"),
+                              "sources":json.dumps({str(y):s for y,s in self.sources.items()})})
+        for name in ("count","sum","sumsq"):
+            for v,da in getattr(self,name).data_vars.items():
+                out["{}_{}".format(name,v)]=da
+        for v,da in self.annual.data_vars.items():
+            out["annual_{}".format(v)]=da
+        out.to_netcdf(filename+".tmp")
+        os.replace(filename+".tmp",filename)
+
+    @classmethod
+    def open(cls,filename):
+        " Load an accumulator saved with to_netcdf"
+        with xr.open_dataset(filename) as ds:
+            ds=ds.load()
+        acc=cls(ds.attrs["group"],ds.attrs["leap"])
+        acc.years=[int(y) for y in np.atleast_1d(ds.attrs["years"])]
+        acc.sources={int(y):s for y,s in json.loads(ds.attrs.get("sources","{}")).items()}
+        for name in ("count","sum","sumsq","annual"):
+            prefix=name+"_"
+            part=ds[[v for v in ds.data_vars if v.startswith(prefix)]]
+            part=part.rename({v:v[len(prefix):] for v in part.data_vars})
+            setattr(acc,name,part if part.data_vars else None)
+        return acc
+
+
+def _stamp(filename):
+    " [size, mtime] of a file, to see whether it changed"
+    stat=os.stat(filename)
+    return [stat.st_size,stat.st_mtime]
+
+
+def _open_year(filename,year,changetime=False,timescale="monthly",timecord="time",calendar=None,variables=None):
+    " Open and load one yearly file (only some variables if given), fixing its time as netcdf.from_files does"
+    with xr.open_dataset(filename) as ds:
+        if variables!=None:
+            ds=ds[variables]
+        if changetime==True:
+            ds=ds.assign_coords({timecord:_make_time(ds.sizes[timecord],year,timescale,calendar)})
+        if timecord!="time":
+            ds=ds.rename(name_dict={timecord:"time"})
+        return ds.load()
+
+
+def _stream_climatology(pattern,years=None,groups=("month","dayofyear"),variables=None,leap="feb28",
+                        changetime=False,timescale="monthly",timecord="time",calendar=None):
+    """Monthly and day-of-year climatologies of yearly files, in one streaming pass.
+
+    Args:
+        pattern (str): The yearly files, see netcdf.from_files.
+        years (iterable, optional): Years to use, e.g. the base period. Defaults to all files.
+        groups (tuple, optional): Climatologies to build, "month" and/or "dayofyear". Defaults to both.
+        variables (list, optional): Variables to use. Defaults to all numerical variables with time.
+        leap (str, optional): Leap day handling of the day-of-year climatology. Defaults to "feb28".
+        changetime, timescale, timecord, calendar: Time fixing of every file, see netcdf.from_files.
+
+    Returns:
+        dict: One ClimatologyAccumulator per group, use .mean(), .variance() or .std().
+    """
+    accumulators={g:ClimatologyAccumulator(g,leap) for g in groups}
+    for year,filename in _yearly_files(pattern,years):
+        ds=_open_year(filename,year,changetime,timescale,timecord,calendar,variables)
+        for acc in accumulators.values():
+            acc.add(ds,_stamp(filename))
+    return accumulators
+
+
+def _stream_anomaly(pattern,accumulator,outpattern,years=None,variables=None,standardize=False,
+                    changetime=False,timescale="monthly",timecord="time",calendar=None):
+    """Write the anomalies of yearly files, one year at a time.
+
+    Args:
+        pattern (str): The yearly files, see netcdf.from_files.
+        accumulator (ClimatologyAccumulator): The climatology, from _stream_climatology.
+        outpattern (str): Output files, "{}" is replaced by the year, e.g. "anom/hgt_anom_{}.nc".
+        years (iterable, optional): Years to write. Defaults to all files.
+        variables (list, optional): Variables to use. Defaults to those of the climatology.
+        standardize (bool, optional): Divide by the standard deviation. Defaults to False.
+        changetime, timescale, timecord, calendar: Time fixing of every file, see netcdf.from_files.
+
+    Returns:
+        list: The files written.
+    """
+    clim=accumulator.mean()
+    std=accumulator.std() if standardize==True else None
+    variables=variables if variables!=None else list(clim.data_vars)
+
+    written=[]
+    for year,filename in _yearly_files(pattern,years):
+        ds=_open_year(filename,year,changetime,timescale,timecord,calendar,variables)
+        key=accumulator._key(ds.time)
+        anomaly=ds.groupby(key)-clim[variables]
+        if std is not None:
+            anomaly=anomaly.groupby(key)/std[variables]
+        anomaly=anomaly.drop_vars(accumulator.group)
+        for v in variables:
+            anomaly[v].attrs=ds[v].attrs
+
+        outfile=outpattern.format(year)
+        if os.path.dirname(outfile)!="":
+            os.makedirs(os.path.dirname(outfile),exist_ok=True)
+        anomaly.to_netcdf(outfile+".tmp")
+        os.replace(outfile+".tmp",outfile)
+        written.append(outfile)
+    return written
+
+
+def _update_climatology(pattern,store,years,group="month",leap="feb28",variables=None,
+                        changetime=False,timescale="monthly",timecord="time",calendar=None):
+    """Bring a saved climatology to a new set of years, reading only the years that change.
+
+    A new year is added, and moving the base period (e.g. 1981-2010 to
+    1991-2020) adds the new years and removes the old ones. If the file of a
+    year that is kept or removed changed (size or modification time), was not
+    recorded, or a removed year has no file anymore, its old data cannot be
+    taken out, so the climatology is built again from the wanted years.
+
+    Args:
+        pattern (str): The yearly files, see netcdf.from_files.
+        store (str): File of the ClimatologyAccumulator, created if needed.
+        years (iterable): The years the climatology should cover.
+        group (str, optional): "month" or "dayofyear", for a new store. Defaults to "month".
+        leap (str, optional): Leap day handling, for a new store. Defaults to "feb28".
+        variables (list, optional): Variables to use. Defaults to all numerical variables with time.
+        changetime, timescale, timecord, calendar: Time fixing of every file, see netcdf.from_files.
+
+    Returns:
+        ClimatologyAccumulator: the updated climatology.
+    """
+    acc=ClimatologyAccumulator.open(store) if os.path.exists(store) else ClimatologyAccumulator(group,leap)
+    wanted=set(years)
+    files={y:f for y,f in _yearly_files(pattern,sorted(wanted|set(acc.years))) if os.path.exists(f)}
+
+    def changed(y):
+        return y in files and acc.sources.get(y)!=_stamp(files[y])
+    if any(changed(y) for y in set(acc.years)&wanted) or any(y not in files or changed(y) for y in set(acc.years)-wanted):
+        acc=ClimatologyAccumulator(acc.group,acc.leap)
+    new=sorted(wanted-set(acc.years))
+    old=sorted(set(acc.years)-wanted)
+    if not new and not old:
+        return acc
+
+    for adding,todo in ((True,new),(False,old)):
+        for year in todo:
+            if year not in files:
+                raise FileNotFoundError("No file of {} for {}".format(pattern,year))
+            ds=_open_year(files[year],year,changetime,timescale,timecord,calendar,variables)
+            if adding:
+                acc.add(ds,_stamp(files[year]))
+            else:
+                acc.remove(ds)
+    acc.to_netcdf(store)
+    return acc
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def test_array_cache_is_time_contiguous_and_mapped(tmp_path):
+    ds=_field(nt=50,nlat=5,nlon=7,seed=15)
+    ds["air"]=ds["air"].expand_dims(level=[850.0,500.0],axis=1).copy()
+    nc=netcdf(ds)
+
+    da=nc._array_cache("air",path=str(tmp_path))
+    assert da.dims==("level","lat","lon","time")
+    assert isinstance(da.values.base,np.memmap)
+    assert not da.values.flags.writeable
+    np.testing.assert_array_equal(da,ds["air"].transpose("level","lat","lon","time"))
+    series=da.values[1,2,3]
+    assert series.flags.c_contiguous and np.shares_memory(series,da.values)
+    np.testing.assert_array_equal(da.time,ds.time)
+
+    # file backed data is reused until the files change
+    ds.to_netcdf(tmp_path/"air_2000.nc")
+    files=netcdf.from_files(str(tmp_path/"air_{}.nc"),years=[2000])
+    source=files._array_cache("air",path=str(tmp_path/"cache")).encoding["source"]
+    mtime=os.stat(source).st_mtime_ns
+    again=files._array_cache("air",path=str(tmp_path/"cache"))
+    assert again.encoding["source"]==source and os.stat(source).st_mtime_ns==mtime
+    assert len([f for f in os.listdir(tmp_path/"cache") if f.endswith(".npy")])==1
+
+    # a dataset changed in memory is not served the file of the source
+    files.ds=files.ds-273.15
+    converted=files._array_cache("air",path=str(tmp_path/"cache"))
+    assert converted.encoding["source"]!=source
+    np.testing.assert_allclose(converted,ds["air"].transpose("level","lat","lon","time")-273.15)
+    files.ds=files.ds+1
+    np.testing.assert_allclose(files._array_cache("air",path=str(tmp_path/"cache")),converted+1)
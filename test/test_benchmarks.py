@@ -0,0 +1,17 @@
+import json
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","benchmarks"))
+import bench_netcdf
+
+
+def test_benchmark_suite_runs_and_writes_json(tmp_path):
+    out=bench_netcdf.run(grid="2.5",years=1,timescales=("daily",),repeat=1)
+
+    names={r["name"] for r in out["results"]}
+    assert names=={"init_changetime","mon_climatology","monthly_anomaly","annual_mean",
+                   "zonal_mean","correlate","daily_anomaly"}
+    assert all(r["seconds"]>0 and r["shape"]==[365,73,144] for r in out["results"])
+    json.dump(out,open(tmp_path/"b.json","w"))
+    bench_netcdf.compare(out,json.load(open(tmp_path/"b.json")))
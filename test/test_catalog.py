@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from catalog import Catalog, catalog_name
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def _write(path,year,lon0=0):
+    ds=_field(nt=12,nlat=5,nlon=8,seed=year,start="{}-01-01".format(year))
+    ds["air"]=ds["air"].expand_dims(level=[850.0,500.0],axis=1).copy()
+    ds=ds.assign_coords(lon=lon0+np.arange(8)*10.0)
+    ds.to_netcdf(path/"air_{}.nc".format(year))
+
+
+def test_catalog_is_incremental_and_selects_files(tmp_path):
+    for year in (2000,2001,2002):
+        _write(tmp_path,year)
+    cat=Catalog(str(tmp_path))
+    assert os.path.exists(tmp_path/catalog_name)
+    entry=cat.files["air_2001.nc"]
+    assert entry["time"]["start"].startswith("2001-01-01") and entry["time"]["calendar"]=="proleptic_gregorian"
+    assert entry["levels"]==[850.0,500.0] and entry["grid"]["lon"]["size"]==8
+    assert entry["variables"]["air"]["dims"]==["time","level","lat","lon"]
+
+    assert Catalog(str(tmp_path)).refresh()==[]
+    _write(tmp_path,2003)
+    os.remove(tmp_path/"air_2000.nc")
+    again=Catalog(str(tmp_path),refresh=False)
+    assert again.refresh()==["air_2003.nc"] and "air_2000.nc" not in again.files
+
+    assert again.query(time="2002-07")==[str(tmp_path/"air_2002.nc")]
+    assert len(again.query(time=("2001-06","2002")))==2
+    assert again.query(level=300)==[] and again.query(variables=["hgt"])==[]
+    assert len(again.query(lon=(-30,15)))==3 and again.query(lon=(100,200))==[]
+
+    nc=netcdf.from_catalog(str(tmp_path),time=("2002-03","2003-02"),level=500,lat=(-30,30),lon=(20,40))
+    assert nc.files==[str(tmp_path/"air_2002.nc"),str(tmp_path/"air_2003.nc")]
+    assert nc.ds["air"].shape==(12,1,3,3)
+    assert str(nc.ds.time.values[0])[:7]=="2002-03"
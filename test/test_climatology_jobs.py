@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from climatology_jobs import plan, run
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def _files(path,name,years):
+    for yr in years:
+        ds=_field(nt=12,nlat=4,nlon=5,seed=yr,start="{}-01-01".format(yr),name=name)
+        ds[name]=ds[name].expand_dims(level=[850.0,500.0],axis=1).copy()
+        ds.to_netcdf(path/"{}_{}.nc".format(name,yr))
+
+
+def test_jobs_share_one_pass_and_skip_up_to_date_outputs(tmp_path):
+    years=[2000,2001,2002,2003]
+    _files(tmp_path,"hgt",years)
+    _files(tmp_path,"air",years)
+    out=str(tmp_path/"out"/"{product}_{var}_{level}.nc")
+    spec={"workers":2,"jobs":[
+        {"files":str(tmp_path/"hgt_{}.nc"),"years":[2000,2003],"base":[2001,2003],"variables":["hgt"],
+         "levels":[850],"products":["mon_climatology","DJF","JJAS"],"output":out},
+        {"files":str(tmp_path/"hgt_{}.nc"),"years":[2000,2003],"base":[2001,2003],"variables":["hgt"],
+         "levels":[500],"products":["annual_mean"],"output":out},
+        {"files":str(tmp_path/"air_*.nc"),"variables":["air"],"products":["mon_climatology"],
+         "output":str(tmp_path/"out"/"air_clim.nc")}]}
+    tasks=plan(spec)
+    assert len(tasks)==2 and len(tasks[0]["outputs"])==4
+
+    written=run(spec)
+    assert len(written)==5 and not [f for f in os.listdir(tmp_path/"out") if f.endswith(".tmp")]
+
+    nc=netcdf.from_files(str(tmp_path/"hgt_{}.nc"),years=[2001,2002,2003])
+    with xr.open_dataset(tmp_path/"out"/"mon_climatology_hgt_850.nc") as clim:
+        np.testing.assert_allclose(clim["hgt"],nc._mon_climatology()["hgt"].sel(level=[850.0]))
+        assert clim.attrs["base_period"]=="2001-2003"
+    with xr.open_dataset(tmp_path/"out"/"DJF_hgt_850.nc") as djf:
+        np.testing.assert_allclose(djf["hgt"],nc._mean_seasonal_climatology("DJF")["hgt"].sel(level=[850.0]))
+    with xr.open_dataset(tmp_path/"out"/"annual_mean_hgt_500.nc") as annual:
+        assert list(annual.year.values)==years and list(annual.level.values)==[500.0]
+
+    assert run(spec,workers=1)==[]
+    os.utime(tmp_path/"air_2001.nc",(0,0))
+    assert run(spec,workers=1)==[str(tmp_path/"out"/"air_clim.nc")]
+
+
+def test_seasons_of_daily_data_match_the_netcdf_class(tmp_path):
+    for yr in (2001,2002):
+        _field(nt=365,nlat=3,nlon=4,seed=yr,start="{}-01-01".format(yr),freq="D").to_netcdf(tmp_path/"air_{}.nc".format(yr))
+    spec=[{"files":str(tmp_path/"air_{}.nc"),"years":[2001,2002],"variables":["air"],"products":["DJF","JJAS"],
+           "output":str(tmp_path/"{product}.nc")}]
+    run(spec)
+
+    nc=netcdf.from_files(str(tmp_path/"air_{}.nc"),years=[2001,2002])
+    for season in ("DJF","JJAS"):
+        with xr.open_dataset(tmp_path/"{}.nc".format(season)) as out:
+            np.testing.assert_allclose(out["air"],nc._mean_seasonal_climatology(season)["air"],rtol=1e-6)
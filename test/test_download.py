@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from get_data import _getdata, _download, _session, _load_manifest, manifest_name
+
+
+FILES={yr:bytes(range(256))*(40+yr%7) for yr in range(1990,1996)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    "Serves FILES at /hgt.{yr}.nc, honours single 'bytes=a-' ranges, If-Range and ETags"
+    requests_seen=[]
+    headers_seen=[]
+
+    def do_GET(self):
+        yr=int(self.path.split(".")[1])
+        if yr not in FILES:
+            self.requests_seen.append((self.path,None))
+            self.send_response(404)
+            self.end_headers()
+            return
+        body=FILES[yr]
+        etag='"{}"'.format(hash(body))
+        rng=self.headers.get("Range")
+        self.requests_seen.append((self.path,rng))
+        self.headers_seen.append(dict(self.headers))
+        if self.headers.get("If-None-Match")==etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.headers.get("If-Range") not in (None,etag):
+            rng=None
+        if rng!=None:
+            start=int(rng.split("=")[1].split("-")[0])
+            if start>=len(body):
+                self.send_response(416)
+                self.end_headers()
+                return
+            body=body[start:]
+            self.send_response(206)
+            self.send_header("Content-Range","bytes {}-{}/{}".format(start,len(FILES[yr])-1,len(FILES[yr])))
+        else:
+            self.send_response(200)
+        self.send_header("ETag",etag)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.requests_seen=[]
+    _Handler.headers_seen=[]
+    httpd=ThreadingHTTPServer(("127.0.0.1",0),_Handler)
+    thread=threading.Thread(target=httpd.serve_forever,daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/hgt.{{}}.nc".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_getdata_downloads_every_year(server,tmp_path):
+    files=_getdata(1990,1995,path=str(tmp_path)+"/",Outfilename="hgt_",url=server,workers=3,chunk_size=100)
+
+    assert files==[str(tmp_path)+"/hgt_{}.nc".format(yr) for yr in range(1990,1996)]
+    for yr,f in zip(range(1990,1996),files):
+        with open(f,"rb") as fh:
+            assert fh.read()==FILES[yr]
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".part")]
+
+
+def _partial(outfile,data,body):
+    " A partial download of body, as left by an interrupted _download"
+    with open(outfile+".part","wb") as fh:
+        fh.write(data)
+    with open(outfile+".part.json","w") as fh:
+        json.dump({"etag":'"{}"'.format(hash(body)),"last_modified":None},fh)
+
+
+def test_download_resumes_partial_file(server,tmp_path):
+    outfile=str(tmp_path/"hgt_1991.nc")
+    _partial(outfile,FILES[1991][:1000],FILES[1991])
+
+    _download(_session(),server.format(1991),outfile)
+
+    with open(outfile,"rb") as fh:
+        assert fh.read()==FILES[1991]
+    assert _Handler.requests_seen==[("/hgt.1991.nc","bytes=1000-")]
+    assert os.listdir(tmp_path)==["hgt_1991.nc"]
+
+
+def test_download_restarts_when_remote_file_changed(server,tmp_path):
+    outfile=str(tmp_path/"hgt_1993.nc")
+    old=FILES[1993]
+    _partial(outfile,old[:1000],old)
+    FILES[1993]=old[::-1]
+    try:
+        _download(_session(),server.format(1993),outfile)
+        with open(outfile,"rb") as fh:
+            assert fh.read()==FILES[1993]
+    finally:
+        FILES[1993]=old
+
+
+def test_download_restarts_partial_file_of_unknown_version(server,tmp_path):
+    outfile=str(tmp_path/"hgt_1994.nc")
+    with open(outfile+".part","wb") as fh:
+        fh.write(b"x"*1000)
+
+    _download(_session(),server.format(1994),outfile)
+
+    with open(outfile,"rb") as fh:
+        assert fh.read()==FILES[1994]
+    assert _Handler.requests_seen==[("/hgt.1994.nc",None)]
+
+
+def test_download_restarts_when_partial_is_too_long(server,tmp_path):
+    outfile=str(tmp_path/"hgt_1992.nc")
+    _partial(outfile,b"x"*(len(FILES[1992])+10),FILES[1992])
+
+    _download(_session(),server.format(1992),outfile,headers={"X-Client":"pyclim"})
+
+    with open(outfile,"rb") as fh:
+        assert fh.read()==FILES[1992]
+    # the caller's headers are kept when starting again
+    assert [r for _,r in _Handler.requests_seen]==["bytes={}-".format(len(FILES[1992])+10),None]
+    assert [h.get("X-Client") for h in _Handler.headers_seen]==["pyclim","pyclim"]
+
+
+def test_getdata_rerun_only_fetches_changed_years(server,tmp_path):
+    path=str(tmp_path)+"/"
+    _getdata(1990,1993,path=path,Outfilename="hgt_",url=server)
+    manifest=_load_manifest(path+manifest_name)
+    assert sorted(manifest)==["hgt_{}.nc".format(yr) for yr in range(1990,1994)]
+    assert manifest["hgt_1990.nc"]["size"]==len(FILES[1990])
+
+    _Handler.requests_seen=[]
+    FILES[1991]=FILES[1991][::-1]+b"new"
+    try:
+        files=_getdata(1990,1993,path=path,Outfilename="hgt_",url=server)
+    finally:
+        FILES[1991]=FILES[1991][:-3][::-1]
+
+    assert len(_Handler.requests_seen)==4
+    with open(files[1],"rb") as fh:
+        assert fh.read().endswith(b"new")
+    assert _load_manifest(path+manifest_name)["hgt_1991.nc"]["size"]==len(FILES[1991])+3
+
+
+def test_getdata_offline_sends_no_request(server,tmp_path):
+    path=str(tmp_path)+"/"
+    _getdata(1990,1991,path=path,Outfilename="hgt_",url=server)
+    _Handler.requests_seen=[]
+
+    _getdata(1990,1991,path=path,Outfilename="hgt_",url=server,offline=True,verify=True)
+    assert _Handler.requests_seen==[]
+
+    os.remove(path+"hgt_1991.nc")
+    with pytest.raises(IOError):
+        _getdata(1990,1991,path=path,Outfilename="hgt_",url=server,offline=True)
+
+
+def test_getdata_records_the_years_done_when_one_fails(server,tmp_path):
+    path=str(tmp_path)+"/"
+    with pytest.raises(Exception):
+        _getdata(1989,1991,path=path,Outfilename="hgt_",url=server)
+    assert sorted(_load_manifest(path+manifest_name))==["hgt_1990.nc","hgt_1991.nc"]
+
+    # the rerun only checks them
+    mtime=os.stat(path+"hgt_1990.nc").st_mtime_ns
+    _getdata(1990,1991,path=path,Outfilename="hgt_",url=server)
+    assert all("If-None-Match" in h for h in _Handler.headers_seen[-2:])
+    assert os.stat(path+"hgt_1990.nc").st_mtime_ns==mtime
@@ -1,7 +1,7 @@
 import numpy as np
 import sys
 
-sys.path.insert(0,"../scr/")
+sys.path.insert(0,"../src/")
 from get_data import _getdata
 #import _getdata 
 
@@ -10,4 +10,5 @@ e=2010
 path="../scrap/"
 output="2m_air"
 
-_getdata(s,e,path,output)
+if __name__=="__main__":
+    _getdata(s,e,path,output)
@@ -0,0 +1,31 @@
+import numpy as np
+from scipy.stats import linregress
+
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def _trend(series):
+    fit=linregress(np.arange(len(series)),series)
+    return fit.slope,fit.pvalue
+
+
+def _block_mean(block):
+    return block.mean(axis=1)
+
+
+def test_apply_gridpoint_on_tiles_across_processes(tmp_path):
+    ds=_field(nt=40,nlat=9,nlon=10,seed=16)
+    ds["air"]=ds["air"]+0.05*np.arange(40)[:,None,None]
+    nc=netcdf(ds)
+
+    out=nc._apply_gridpoint(_trend,"air",workers=2,tile=(4,3),dim="stat",path=str(tmp_path))
+    assert out.dims==("lat","lon","stat") and out.shape==(9,10,2)
+    np.testing.assert_array_equal(out.lon,ds.lon)
+    fit=linregress(np.arange(40),ds["air"][:,7,9].values)
+    np.testing.assert_allclose(out[7,9],[fit.slope,fit.pvalue])
+
+    mean=nc._apply_gridpoint(_block_mean,"air",workers=1,block=True,path=str(tmp_path))
+    assert mean.dims==("lat","lon")
+    np.testing.assert_allclose(mean,ds["air"].mean("time"))
+    assert not [f for f in tmp_path.iterdir() if f.name.startswith("tmp")]
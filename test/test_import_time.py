@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+
+SRC=os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src")
+
+SCRIPT="""
+import sys,time
+st=time.perf_counter()
+import netcdf_analysis
+print(time.perf_counter()-st)
+print(",".join(m for m in ("matplotlib","cartopy","shapely","pyproj","scipy") if m in sys.modules))
+"""
+
+
+def _import_netcdf_analysis():
+    out=subprocess.run([sys.executable,"-c",SCRIPT],cwd=SRC,capture_output=True,text=True,check=True)
+    elapsed,modules=out.stdout.split("\n")[:2]
+    return float(elapsed),modules
+
+
+def test_analysis_import_does_not_load_plotting_stack():
+    elapsed,modules=_import_netcdf_analysis()
+    print("import netcdf_analysis: {:.3f} s".format(elapsed))
+    assert modules==""
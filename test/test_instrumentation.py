@@ -0,0 +1,36 @@
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def test_profiling_records_nested_calls_and_phases():
+    nc=netcdf(_field(48,4,6))
+    assert nc.profiler is None
+    events=[]
+    profiler=nc._set_profiling(callback=events.append)
+
+    nc._monthly_anomaly()
+    nc._monthly_anomaly()
+    nc._return_ds()
+
+    report=profiler.report()
+    assert list(report.method)==["_mon_climatology","_monthly_anomaly","_monthly_anomaly","_return_ds"]
+    assert list(report.depth)==[1,0,0,0]
+    assert list(report.phase)==["compute","compute","compute","save"]
+    assert len(report)==len(events)
+    assert (report.seconds>=0).all() and (report.peak_mb>=0).all()
+    assert report["shape"].iloc[0]=={"month":12,"lat":4,"lon":6}
+
+    summary=profiler.summary()
+    assert summary.loc[("compute","_monthly_anomaly"),"calls"]==2
+
+    assert nc._set_profiling(False) is None
+    nc._annual_mean()
+    assert len(profiler.events)==4
+
+
+def test_from_files_profile_argument(tmp_path):
+    _field(12,4,6).to_netcdf(tmp_path/"air_2000.nc")
+    assert netcdf.from_files(str(tmp_path/"air_*.nc"),profile=False).profiler is None
+    nc=netcdf.from_files(str(tmp_path/"air_*.nc"),profile=True)
+    assert list(nc.profiler.report().method)==["from_files"]
+    nc.profiler.stop()
@@ -0,0 +1,20 @@
+import os
+
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+
+
+def test_render_monthly_climatology_frames(tmp_path):
+    nc=netcdf(_field(nt=24,nlat=10,nlon=12,seed=13))
+
+    files=nc._render_maps("air",str(tmp_path/"clim_{:02d}.png"),product="monthly_climatology",
+                          frames=[0,5,11],workers=2,land=False,features=False)
+
+    assert files==[str(tmp_path/"clim_{:02d}.png".format(i)) for i in range(3)]
+    assert all(os.path.getsize(f)>0 for f in files)
+
+
+def test_render_animation(tmp_path):
+    nc=netcdf(_field(nt=4,nlat=10,nlon=12,seed=14))
+    nc._render_maps("air",str(tmp_path/"air.gif"),clim=[-2,2],land=False,features=False)
+    assert os.path.getsize(tmp_path/"air.gif")>0
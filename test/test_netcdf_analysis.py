@@ -0,0 +1,323 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy.stats import linregress
+
+from netcdf_analysis import netcdf
+
+
+def _field(nt=120,nlat=6,nlon=8,seed=0,start="2000-01-01",freq="MS",name="air"):
+    rng=np.random.default_rng(seed)
+    time=pd.date_range(start,periods=nt,freq=freq)
+    data=rng.normal(size=(nt,nlat,nlon))
+    return xr.Dataset({name:(("time","lat","lon"),data)},
+                      coords={"time":time,"lat":np.linspace(60,-60,nlat),"lon":np.arange(nlon)*45.0})
+
+
+def test_correlate_matches_linregress_with_nans_and_lag():
+    x=_field(seed=1)
+    y=_field(seed=2)
+    y["air"]=y["air"]+0.8*x["air"].shift(time=2)
+    x["air"][5:9,1,2]=np.nan
+    y["air"][50,3,4]=np.nan
+
+    out=netcdf(x)._correlate("air",y,lag=2,max_memory=0)
+
+    for i,j in [(0,0),(1,2),(3,4),(5,7)]:
+        xs=x["air"][:-2,i,j].values
+        ys=y["air"][2:,i,j].values
+        ok=np.isfinite(xs)&np.isfinite(ys)
+        ref=linregress(xs[ok],ys[ok])
+        assert out["corr"][i,j]==pytest.approx(ref.rvalue)
+        assert out["slope"][i,j]==pytest.approx(ref.slope)
+        assert out["intercept"][i,j]==pytest.approx(ref.intercept)
+        assert out["pvalue"][i,j]==pytest.approx(ref.pvalue)
+        assert out["n"][i,j]==ok.sum()
+    assert out["corr"].dims==("lat","lon")
+    np.testing.assert_array_equal(out.lat,x.lat)
+
+
+def test_correlate_with_index_and_siglevel():
+    x=_field(seed=3)
+    index=x["air"][:,0,0].drop_vars(["lat","lon"])
+
+    out=netcdf(x)._correlate("air",index,siglevel=0.01)
+
+    assert out["corr"][0,0]==pytest.approx(1.0)
+    assert np.isnan(out["corr"]).sum()>0
+
+
+def test_daily_anomaly_handles_leap_and_partial_years():
+    ds=_field(nt=3*365+100,freq="D",start="1999-01-01",seed=4)
+    ds["air"].attrs["units"]="K"
+
+    out=netcdf(ds)._daily_anomaly("air")
+
+    assert list(out.data_vars)==["air"]
+    assert out["air"].attrs["units"]=="K"
+    assert out["air"].dims==ds["air"].dims
+    np.testing.assert_array_equal(out.time,ds.time)
+    # Mar 1 is grouped with Mar 1 in every year, Feb 29 2000 with Feb 28
+    mar1=ds["air"].sel(time=ds.time.dt.strftime("%m-%d")=="03-01")
+    np.testing.assert_allclose(out["air"].sel(time="2000-03-01"),(mar1-mar1.mean("time")).sel(time="2000-03-01"))
+    feb28=ds["air"].sel(time=ds.time.dt.strftime("%m-%d").isin(["02-28","02-29"]))
+    np.testing.assert_allclose(out["air"].sel(time="2000-02-29"),(feb28-feb28.mean("time")).sel(time="2000-02-29"))
+
+
+def test_daily_anomaly_is_lazy_and_smooths():
+    ds=_field(nt=4*365,freq="D",seed=5)
+    t=np.arange(ds.sizes["time"])
+    ds["air"]=ds["air"]*0+np.cos(2*np.pi*t/365.25)[:,None,None]
+    ds=ds.chunk({"time":365})
+
+    out=netcdf(ds)._daily_anomaly("air",smooth="harmonic",nharm=2)
+    assert out["air"].chunks!=None
+    assert float(abs(out["air"]).max())<0.05
+
+    clim=netcdf(ds)._daily_climatology("air",smooth="running",window=15)
+    assert clim.sizes["dayofyear"]==365
+
+
+def test_climatology_is_computed_once_and_invalidated():
+    nc=netcdf(_field(seed=6))
+
+    clim=nc._mon_climatology()
+    assert nc._mon_climatology() is clim
+    nc._monthly_anomaly()
+    nc._mean_seasonal_climatology("JJA")
+    assert nc.cache.misses==3
+    assert nc.cache.hits==3
+    assert nc._daily_climatology("air") is nc._daily_climatology("air",lv=0)
+
+    nc._clear_cache("_mon_climatology")
+    assert nc._mon_climatology() is not clim
+    nc._clear_cache()
+    assert len(nc.cache)==0
+
+
+def test_reassigning_ds_invalidates_the_cache():
+    ds=_field(nt=24,seed=18)
+    nc=netcdf(ds)
+    for k in range(1,6):
+        nc._mon_climatology()
+        nc.ds=nc.ds+1
+        expected=(ds+k).groupby("time.month").mean("time")
+        xr.testing.assert_allclose(nc._mon_climatology(),expected)
+    nc.ds=nc.ds-273.15
+    xr.testing.assert_allclose(nc._mon_climatology(),(ds+5-273.15).groupby("time.month").mean("time"))
+
+
+def test_store_reuses_products_across_sessions(tmp_path):
+    source=str(tmp_path/"air.nc")
+    _field(nt=24,seed=7).to_netcdf(source)
+    store=str(tmp_path/"store")
+
+    with xr.open_dataset(source) as ds:
+        first=netcdf(ds,store=store)._mon_climatology()
+        clim=netcdf(ds,store=store)._daily_climatology("air")
+    assert len(os.listdir(store))==2
+
+    with xr.open_dataset(source) as ds:
+        nc=netcdf(ds,store=store)
+        xr.testing.assert_identical(nc._mon_climatology(),first)
+        xr.testing.assert_allclose(nc._daily_climatology("air"),clim)
+        # a dataset changed in memory is recomputed, and not saved
+        nc.ds=nc.ds.assign(air=nc.ds["air"]*0)
+        assert (nc._mon_climatology()["air"]==0).all()
+        inplace=netcdf(ds.copy(deep=True),store=store,files=[source])
+        inplace.ds["air"][:]=1
+        inplace._clear_cache()
+        assert (inplace._mon_climatology()["air"]==1).all()
+        assert netcdf(ds,store=store,dtype="float32")._mon_climatology()["air"].dtype==np.float32
+    assert len(os.listdir(store))==3
+
+    _field(nt=24,seed=8).to_netcdf(source)
+    with xr.open_dataset(source) as ds:
+        assert not netcdf(ds,store=store)._mon_climatology().identical(first)
+    assert len(os.listdir(store))==4
+
+
+def test_from_files_opens_yearly_files_lazily(tmp_path):
+    years=[1990,1991,1992]
+    for yr in years:
+        ds=_field(nt=365,freq="D",seed=yr)
+        ds=ds.assign_coords(time=np.arange(365.0)).rename(time="t")
+        ds.to_netcdf(tmp_path/"hgt_{}.nc".format(yr))
+
+    nc=netcdf.from_files(str(tmp_path/"hgt_{}.nc"),years=years,changetime=True,timescale="daily",timecord="t")
+    assert nc.ds["air"].chunks[0]==(365,365,365)
+    assert str(nc.ds.time.values[365])[:10]=="1991-01-01"
+    assert nc.files==[str(tmp_path/"hgt_{}.nc".format(yr)) for yr in years]
+
+    glob_nc=netcdf.from_files(str(tmp_path/"hgt_*.nc"),years=[1991,1992],changetime=True,timescale="daily",timecord="t")
+    np.testing.assert_array_equal(glob_nc.ds["air"].values,nc.ds["air"][365:].values)
+
+
+def test_default_file_chunks_are_capped():
+    from netcdf_analysis import _file_chunks
+
+    ds=_field(nt=365,nlat=10,nlon=20,freq="D")
+    ds["air"]=ds["air"].expand_dims(level=[850.0,500.0],axis=1)
+    # one level of one day is 10*20*8=1600 bytes
+    assert _file_chunks(ds)=={"time":365,"level":1,"lat":-1,"lon":-1}
+    assert _file_chunks(ds,chunk_bytes=16000)["time"]==10
+    assert _file_chunks(ds,chunk_bytes=800)=={"time":1,"level":1,"lat":5,"lon":-1}
+
+
+def test_lazy_execution_mode():
+    ds=_field(nt=48,seed=9)
+    eager=netcdf(ds.copy())._monthly_anomaly()
+
+    nc=netcdf(ds.copy())._set_execution(scheduler="synchronous",workers=2,memory_limit="64kB")
+    assert nc.ds["air"].chunks!=None
+    anomaly=nc._monthly_anomaly()
+    assert anomaly["air"].chunks!=None
+    xr.testing.assert_allclose(nc._compute(anomaly),eager)
+    # the cached products are computed once, and only their chunks are kept
+    clim=nc._mon_climatology()["air"]
+    assert len(clim.__dask_graph__())==clim.data.npartitions
+    assert nc._mon_climatology()["air"].data is clim.data
+
+    # the memory limit also applies to data that is already chunked
+    chunked=netcdf(ds.chunk({"time":48}))._set_execution(memory_limit="64kB",workers=2)
+    assert max(chunked.ds["air"].chunks[0])<48
+
+    nc._zonal_mean("air",ds.lat)
+    nc._set_execution(lazy=False)
+    assert nc.ds["air"].chunks==None
+
+
+def test_changetime_calendars():
+    from netcdf_analysis import _make_time
+
+    old=pd.date_range("1981-01-01","2020-12-31",freq="D")
+    old=old[~((old.month==2)&(old.day==29))]
+    np.testing.assert_array_equal(_make_time(len(old),1981,"daily"),old.values)
+
+    six=_make_time(8,"2000-02-28T12:00","6h",calendar="noleap")
+    assert pd.Timestamp(six[2])==pd.Timestamp("2000-03-01")
+    assert len(_make_time(30,1981,"monthly"))==30
+    assert _make_time(720,1981,"daily",calendar="360_day")[-1].day==30
+    assert _make_time(3,1984,"daily",calendar="standard")[-1]==pd.Timestamp("1984-01-03")
+
+    ds=_field(nt=365*2+10,freq="D",seed=10)
+    before=ds.time.values.copy()
+    nc=netcdf(ds,changetime=True,timescale="daily",start=1990)
+    np.testing.assert_array_equal(ds.time.values,before)
+    assert str(nc.ds.time.values[-1])[:10]=="1992-01-10"
+    assert nc.ds["air"].values is ds["air"].values
+
+
+def test_area_weighted_reductions():
+    ds=_field(nt=24,nlat=13,nlon=12,seed=11)
+    ds["air"][3,2,4]=np.nan
+    nc=netcdf(ds)
+
+    box=nc._box_mean("air",lat=(-30,30),lon=(90,200))
+    sub=ds["air"].sel(lat=slice(30,-30),lon=slice(90,200))
+    w=np.cos(np.deg2rad(sub.lat))*xr.ones_like(sub)
+    w=w.where(sub.notnull(),0)
+    np.testing.assert_allclose(box,(sub.fillna(0)*w).sum(["lat","lon"])/w.sum(["lat","lon"]))
+    assert box.dims==("time",)
+
+    zonal=nc._zonal_average("air",timemean=True)
+    np.testing.assert_allclose(zonal,ds["air"].mean(["time","lon"]))
+    assert nc._global_mean("air",time=("2000-06-01","2000-12-31")).sizes["time"]==7
+    assert nc._meridional_average("air",lat=(-15,15)).dims==("time","lon")
+
+
+def test_vertical_profile_on_levels():
+    ds=_field(nt=24,nlat=7,nlon=6,seed=12)
+    ds["air"]=ds["air"].expand_dims(level=[1000.0,850.0,500.0],axis=1)
+    netcdf(ds)._vertical_profile("air",ds.lat,ds.lon,ds.level)
+
+
+def test_subset_wraps_longitudes_and_reads_only_the_region(tmp_path):
+    from instrumentation import _bytes_read
+
+    ds=_field(nt=24,nlat=37,nlon=72,seed=13)
+    ds["air"]=ds["air"].expand_dims(level=np.linspace(1000,100,10),axis=1).copy()
+    ds=ds.assign_coords(lon=np.arange(72)*5.0)
+    ds.to_netcdf(tmp_path/"air_2000.nc")
+    nc=netcdf.from_files(str(tmp_path/"air_{}.nc"),years=[2000])
+
+    sub=nc._subset(lat=(-10,10),lon=(-20,15),level=900,time=("2000-03-01","2000-08-31"))
+    assert sub.ds is not nc.ds and sub.files==nc.files
+    assert sub.ds["air"].shape==(6,1,7,8)
+    np.testing.assert_array_equal(sub.ds.lon,[340,345,350,355,360,365,370,375])
+    expected=ds["air"].sel(level=[900.0],lat=slice(10,-10)).isel(time=slice(2,8),lon=[68,69,70,71,0,1,2,3])
+    np.testing.assert_array_equal(sub.ds["air"].values,expected.values)
+    np.testing.assert_array_equal(nc._subset(lon=(340,15)).ds.lon,sub.ds.lon)
+    assert nc._subset(lon=(0,360)).ds.sizes["lon"]==72
+    assert nc._subset(level=(1000,800)).ds.sizes["level"]==3
+
+    before=_bytes_read()
+    sub._box_mean("air",lat=(-10,10),lon=(340,375)).values
+    middle=_bytes_read()
+    nc.ds["air"].values
+    if before!=None:
+        assert middle-before<(_bytes_read()-middle)/4
+
+
+def test_float32_policy_and_compressed_packed_output(tmp_path):
+    ds=_field(nt=120,nlat=19,nlon=36,seed=14)
+    ds["air"]=ds["air"]*10+280
+    ds.to_netcdf(tmp_path/"air_2000.nc")
+
+    nc=netcdf.from_files(str(tmp_path/"air_*.nc"),dtype="float32")
+    assert nc.ds["air"].dtype==np.float32 and nc.ds["air"].chunks!=None
+    assert nc._mon_climatology()["air"].dtype==np.float32
+    assert nc._box_mean("air",lat=(-30,30),lon=(0,90)).dtype==np.float32
+    assert netcdf(ds,dtype="float32").ds["air"].dtype==np.float32
+    with xr.open_dataset(tmp_path/"air_2000.nc") as opened:
+        single=netcdf(opened,dtype="float32")
+        assert single.ds["air"].dtype==np.float32 and not single.ds["air"].variable._in_memory
+        assert single._mon_climatology()["air"].dtype==np.float32
+
+    nc._return_ds(str(tmp_path/"plain.nc"),save=True)
+    nc._return_ds(str(tmp_path/"packed.nc"),save=True,pack=True)
+    assert os.path.getsize(tmp_path/"packed.nc")<os.path.getsize(tmp_path/"plain.nc")<os.path.getsize(tmp_path/"air_2000.nc")
+    assert not os.path.exists(tmp_path/"packed.nc.tmp")
+
+    with xr.open_dataset(tmp_path/"packed.nc") as packed:
+        assert packed["air"].encoding["dtype"]==np.int16 and packed["air"].encoding["shuffle"]
+        np.testing.assert_allclose(packed["air"],ds["air"],atol=float(packed["air"].encoding["scale_factor"]))
+        # a packed source keeps its packing
+        netcdf(packed)._return_ds(str(tmp_path/"repacked.nc"),save=True,pack=True)
+        scale=packed["air"].encoding["scale_factor"]
+    with xr.open_dataset(tmp_path/"repacked.nc") as repacked:
+        assert repacked["air"].encoding["scale_factor"]==scale
+
+
+def test_seasonal_means_and_running_mean():
+    from netcdf_analysis import _season_months
+
+    assert _season_months("JJAS")==[6,7,8,9] and _season_months("DJF")==[12,1,2]
+    with pytest.raises(ValueError):
+        _season_months("JAJ")
+
+    ds=_field(nt=730,nlat=3,nlon=4,seed=17,start="2001-01-01",freq="D")
+    ds["air"][40,1,1]=np.nan
+    nc=netcdf(ds)
+    out=nc._seasonal_means(("DJF","JJAS",(11,12,1)))
+    assert out["air"].dims==("season","year","lat","lon")
+    assert list(out.season.values)==["DJF","JJAS","11-12-1"] and list(out.year.values)==[2001,2002]
+
+    djf=ds["air"].sel(time=slice("2001-12-01","2002-02-28")).mean("time")
+    np.testing.assert_allclose(out["air"].sel(season="DJF",year=2002),djf)
+    assert out["air"].sel(season="DJF",year=2001).isnull().all()
+    jjas=ds["air"].sel(time=slice("2002-06-01","2002-09-30")).mean("time")
+    np.testing.assert_allclose(out["air"].sel(season="JJAS",year=2002),jjas)
+    np.testing.assert_allclose(nc._mean_seasonal_climatology("JJA")["air"],
+                               nc._mon_climatology()["air"].sel(month=[6,7,8]).mean("month"))
+
+    run=nc._running_mean(3)["air"]
+    months=ds["air"][:,0,0].resample(time="MS")
+    expected=months.sum().rolling(time=3).sum()/months.count().rolling(time=3).sum()
+    np.testing.assert_allclose(run[2:,0,0],expected[2:])
+    raw=nc._running_mean(5,monthly=False)["air"]
+    np.testing.assert_allclose(raw[4:,0,0],ds["air"][:,0,0].rolling(time=5).mean()[4:])
+    assert raw[40:45,1,1].isnull().all() and raw[:4].isnull().all()
@@ -0,0 +1,26 @@
+import numpy as np
+
+from product_cache import ProductCache
+
+
+def _key(name):
+    return (name,(("var",name),),())
+
+
+def test_lru_eviction_under_memory_cap():
+    cache=ProductCache(max_memory=2.5*8/2**20)
+    cache.put(_key("a"),np.zeros(1))
+    cache.put(_key("b"),np.zeros(1))
+    cache.get(_key("a"))
+    cache.put(_key("c"),np.zeros(1))
+
+    assert _key("a") in cache and _key("c") in cache
+    assert _key("b") not in cache
+    assert cache.nbytes==16
+
+    cache.put(_key("big"),np.zeros(10))
+    assert _key("big") not in cache
+
+    cache.invalidate(var="a")
+    assert _key("a") not in cache and len(cache)==1
+
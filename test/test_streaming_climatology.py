@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from netcdf_analysis import netcdf
+from test_netcdf_analysis import _field
+from streaming_climatology import ClimatologyAccumulator, _stream_climatology, _stream_anomaly
+
+
+def _write_years(path,years):
+    for yr in years:
+        time=pd.date_range("{}-01-01".format(yr),"{}-12-31".format(yr),freq="D")
+        rng=np.random.default_rng(yr)
+        air=rng.normal(280,5,size=(len(time),4,5))
+        air[10,1,1]=np.nan
+        ds=xr.Dataset({"air":(("time","lat","lon"),air)},
+                      coords={"time":time,"lat":[30.0,10.0,-10.0,-30.0],"lon":np.arange(5)*72.0})
+        ds.to_netcdf(path/"air_{}.nc".format(yr))
+    return str(path/"air_{}.nc")
+
+
+def test_streaming_matches_in_memory(tmp_path):
+    pattern=_write_years(tmp_path,[1999,2000,2001])
+    nc=netcdf.from_files(pattern,years=[1999,2000,2001])
+
+    acc=_stream_climatology(pattern,years=[1999,2000,2001])
+
+    xr.testing.assert_allclose(acc["month"].mean()["air"],nc._mon_climatology()["air"].load())
+    xr.testing.assert_allclose(acc["dayofyear"].mean()["air"],nc._daily_climatology("air").load())
+    monthly_var=nc.ds["air"].groupby("time.month").var("time",ddof=1)
+    xr.testing.assert_allclose(acc["month"].variance()["air"],monthly_var.load())
+
+    files=_stream_anomaly(pattern,acc["dayofyear"],str(tmp_path/"anom"/"air_anom_{}.nc"),years=[1999,2000,2001])
+    with xr.open_mfdataset(files) as anom:
+        xr.testing.assert_allclose(anom["air"].load(),nc._daily_anomaly("air")["air"].load())
+
+
+def test_only_the_requested_variables_are_read(tmp_path,monkeypatch):
+    import streaming_climatology
+    from streaming_climatology import _update_climatology
+
+    for yr in (2000,2001):
+        _field(nt=12,nlat=3,nlon=4,seed=yr,start="{}-01-01".format(yr)).assign(
+            rh=lambda ds: ds["air"]*2).to_netcdf(tmp_path/"air_{}.nc".format(yr))
+    pattern=str(tmp_path/"air_{}.nc")
+    loaded=[]
+    open_year=streaming_climatology._open_year
+
+    def recording_open_year(*args):
+        ds=open_year(*args)
+        loaded.append(list(ds.data_vars))
+        return ds
+    monkeypatch.setattr(streaming_climatology,"_open_year",recording_open_year)
+
+    acc=_stream_climatology(pattern,years=[2000,2001],groups=("month",),variables=["air"])
+    _stream_anomaly(pattern,acc["month"],str(tmp_path/"anom_{}.nc"),years=[2000,2001])
+    _update_climatology(pattern,str(tmp_path/"clim.nc"),[2000,2001],variables=["air"])
+    assert loaded==[["air"]]*6
+
+
+def test_incremental_update_moves_base_period(tmp_path,monkeypatch):
+    import streaming_climatology
+    from streaming_climatology import _update_climatology
+
+    pattern=_write_years(tmp_path,[1999,2000,2001,2002])
+    store=str(tmp_path/"clim.nc")
+    _update_climatology(pattern,store,[1999,2000,2001])
+
+    opened=[]
+    open_year=streaming_climatology._open_year
+    monkeypatch.setattr(streaming_climatology,"_open_year",lambda f,y,*a: opened.append(y) or open_year(f,y,*a))
+    acc=_update_climatology(pattern,store,[2000,2001,2002])
+
+    assert sorted(opened)==[1999,2002]
+    assert acc.years==[2000,2001,2002]
+    nc=netcdf.from_files(pattern,years=[2000,2001,2002])
+    xr.testing.assert_allclose(acc.mean()["air"],nc._mon_climatology()["air"].load())
+    xr.testing.assert_allclose(acc.annual_mean()["air"],nc._annual_mean()["air"].load())
+    xr.testing.assert_allclose(acc.seasonal_mean([6,7,8])["air"],nc._mean_seasonal_climatology("JJA")["air"].load())
+
+    merged=nc._climatology_accumulator()+netcdf.from_files(pattern,years=[1999])._climatology_accumulator()
+    xr.testing.assert_allclose(merged.mean()["air"],netcdf.from_files(pattern,years=[1999,2000,2001,2002])._mon_climatology()["air"].load())
+
+    opened.clear()
+    assert _update_climatology(pattern,store,[2000,2001,2002]).years==[2000,2001,2002]
+    assert opened==[]
+
+    # a year whose file was rewritten is read again
+    with xr.open_dataset(tmp_path/"air_2001.nc") as ds:
+        (ds+10).to_netcdf(tmp_path/"new.nc")
+    os.replace(tmp_path/"new.nc",tmp_path/"air_2001.nc")
+    before=acc.mean()["air"]
+    acc=_update_climatology(pattern,store,[2000,2001,2002])
+    assert ((acc.mean()["air"]-before)>3).all()
+    assert 2001 in opened and acc.sources[2001][0]==os.path.getsize(tmp_path/"air_2001.nc")
+    xr.testing.assert_allclose(acc.mean()["air"],netcdf.from_files(pattern,years=[2000,2001,2002])._mon_climatology()["air"].load())
+
+    # so is a removed year whose file was rewritten, or deleted
+    with xr.open_dataset(tmp_path/"air_2000.nc") as ds:
+        (ds+10).to_netcdf(tmp_path/"new.nc")
+    os.replace(tmp_path/"new.nc",tmp_path/"air_2000.nc")
+    acc=_update_climatology(pattern,store,[2001,2002])
+    xr.testing.assert_allclose(acc.mean()["air"],netcdf.from_files(pattern,years=[2001,2002])._mon_climatology()["air"].load())
+    os.remove(tmp_path/"air_2001.nc")
+    _update_climatology(pattern,store,[2002,1999])
+    xr.testing.assert_allclose(ClimatologyAccumulator.open(store).mean()["air"],
+                               netcdf.from_files(pattern,years=[1999,2002])._mon_climatology()["air"].load())